@@ -1 +1,5 @@
-from pdf_read import convertPDF
+try:
+    from pdf_read import convertPDF
+except ImportError:
+    # pdf_read is optional (not needed to import the package or run tests)
+    convertPDF = None
@@ -1,30 +1,38 @@
 """ bibdb.py """
 
 import os
+import re
 import glob
-import requests
+import time
+import zlib
+import functools
+import collections
+import concurrent.futures
 import pandas as pd
 import numpy as np
 
-import bibtexparser
-from bibtexparser.bparser import BibTexParser
-from bibtexparser.bibdatabase import BibDatabase
-from bibtexparser.bwriter import BibTexWriter
 
-from arxiv2bib import arxiv2bib
+def _bib_parser():
+    """ bibtexparser parser with common strings and non-standard types """
+
+    from bibtexparser.bparser import BibTexParser
+
+    parser = BibTexParser(common_strings=True)
+    parser.ignore_nonstandard_types = False
+    parser.homogenise_fields = False
+    return parser
 
-from py_readpaper import find_author1
 
 def read_bib(filename):
     """ read bibtex file and return bibtexparser object """
 
+    import bibtexparser
+
     if not os.path.exists(filename):
         print("... no bib file: {}".format(filename))
         os.exit(0)
 
-    parser = BibTexParser(common_strings=True)
-    parser.ignore_nonstandard_types = False
-    parser.homogenise_fields = False
+    parser = _bib_parser()
 
     with open(filename) as f:
         bibtex_str = f.read()
@@ -33,14 +41,106 @@ def read_bib(filename):
     return bib_database
 
 
+# start of entry: @type{ or @type(
+_entry_re = re.compile(r'^\s*@\s*(\w+)\s*[{(]')
+
+
+def iter_bib_chunks(filename, chunk_size=2000):
+    """ yield bibtex text of chunk_size entries, with @string definitions so far in front """
+
+    strings = []
+    lines = []
+    n = 0
+    kind = ''
+
+    with open(filename) as f:
+        for line in f:
+            m = _entry_re.match(line)
+            if m is not None:
+                kind = m.group(1).lower()
+                if kind not in ['string', 'preamble', 'comment']:
+                    if n == chunk_size:
+                        yield ''.join(strings + lines)
+                        lines = []
+                        n = 0
+                    n += 1
+
+            if kind == 'string':
+                strings.append(line)
+            else:
+                lines.append(line)
+
+    if n > 0:
+        yield ''.join(strings + lines)
+
+
+def _parse_bib_chunk(bibtex_str):
+    """ entries of bibtex text """
+
+    import bibtexparser
+
+    return bibtexparser.loads(bibtex_str, _bib_parser()).entries
+
+
+def read_bib_entries(filename, chunk_size=2000, workers=1):
+    """ read bib file in chunks of entries (in parallel) into panda db """
+
+    if not os.path.exists(filename):
+        print("... no bib file: {}".format(filename))
+        return pd.DataFrame()
+
+    cols = {}
+    n = 0
+
+    def add(entries):
+        """ append entries to column lists """
+        nonlocal n
+        for e in entries:
+            for k, v in e.items():
+                if k not in cols:
+                    cols[k] = [None] * n
+                cols[k].append(v)
+            n += 1
+            for c in cols.values():
+                if len(c) < n:
+                    c.append(None)
+
+    if workers <= 1:
+        for chunk in iter_bib_chunks(filename, chunk_size=chunk_size):
+            add(_parse_bib_chunk(chunk))
+    else:
+        # keep only a few chunks in flight
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as ex:
+            pending = collections.deque()
+            for chunk in iter_bib_chunks(filename, chunk_size=chunk_size):
+                pending.append(ex.submit(_parse_bib_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    add(pending.popleft().result())
+            while len(pending) > 0:
+                add(pending.popleft().result())
+
+    return pd.DataFrame(cols)
+
+
 def to_bib(pd_db, filename, fromDict=False):
     """ save panda bib records into file """
 
+    from bibtexparser.bibdatabase import BibDatabase
+    from bibtexparser.bwriter import BibTexWriter
+
     if fromDict:
         items = pd_db
     else:
         items = pd_db.astype(str).to_dict("records")
 
+    # records read from pdf files have no entry type and key
+    for i, item in enumerate(items):
+        if item.get('ENTRYTYPE', '') in ['', 'nan']:
+            item['ENTRYTYPE'] = 'article'
+        if item.get('ID', '') in ['', 'nan']:
+            fname = item.get('local-url', '')
+            item['ID'] = os.path.basename(fname).replace('.pdf', '') if fname not in ['', 'nan'] else str(i)
+
     db = BibDatabase()
 
     db.entries = items
@@ -52,16 +152,28 @@ def to_bib(pd_db, filename, fromDict=False):
     print('... save to {}'.format(filename))
 
 
-def read_paperdb(filename, update=False):
-    """ read bib file or csv file """
+def csv_filename(filename):
+    """ csv cache file of bib file """
+
+    return os.path.splitext(filename)[0] + '.csv'
+
+
+def _fresh(filename):
+    """ csv cache exists and is not older than bib file """
+
+    fname_csv = csv_filename(filename)
+    return os.path.exists(fname_csv) and (os.path.getmtime(fname_csv) >= os.path.getmtime(filename))
+
+
+def read_paperdb(filename, update=False, workers=1):
+    """ read bib file or csv file (csv only when newer than bib file) """
 
-    fname_csv = ''.join(filename.split('.')[:-1]) + '.csv'
-    if (not update) and os.path.exists(fname_csv):
+    fname_csv = csv_filename(filename)
+    if (not update) and _fresh(filename):
         print('... read from {}'.format(fname_csv))
         p = pd.read_csv(fname_csv, index_col=0)
     else:
-        bib = read_bib(filename)
-        p = pd.DataFrame.from_dict(bib.entries)
+        p = read_bib_entries(filename, workers=workers)
         p = clean_db(p)
         p.to_csv(fname_csv)
         print('... save to {}'.format(fname_csv))
@@ -69,19 +181,41 @@ def read_paperdb(filename, update=False):
     return clean_db(p)
 
 
-def read_bibfiles(globpattern="*.bib", update=False):
-    """ read bib files with glob pattern """
+def _read_paperdb_timed(filename, update=False):
+    """ read_paperdb with elapsed time """
 
-    flist = glob.glob(globpattern)
+    t0 = time.time()
+    p = read_paperdb(filename, update=update)
+    return p, time.time() - t0
+
+
+def read_bibfiles(globpattern="*.bib", update=False, workers=1):
+    """ read bib files with glob pattern (stale files are parsed in parallel) """
+
+    flist = sorted(glob.glob(globpattern))
     if len(flist) == 0:
         print("... no bib files")
         return
 
-    res = pd.DataFrame()
+    stale = [ f for f in flist if update or (not _fresh(f)) ]
+    res = {}
+
+    if (workers > 1) and (len(stale) > 1):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as ex:
+            for f, out in zip(stale, ex.map(functools.partial(_read_paperdb_timed, update=True), stale)):
+                res[f] = out
+    else:
+        for f in stale:
+            res[f] = _read_paperdb_timed(f, update=True)
 
     for f in flist:
-        p = read_paperdb(f, update=update)
-        res = pd.concat([res, p], ignore_index=True, sort=False)
+        if f not in res:
+            res[f] = _read_paperdb_timed(f)
+
+    for f in flist:
+        print('... {:8.3f} s {:6d} items {} {}'.format(res[f][1], len(res[f][0]), 'bib' if f in stale else 'csv', f))
+
+    res = pd.concat([ res[f][0] for f in flist ], ignore_index=True, sort=False)
 
     # sort by year and author1
     res.sort_values(by=['year', 'author1'], inplace=True)
@@ -135,6 +269,7 @@ def clean_db(p):
 
     # add first author column
     if "author" in p.columns:
+        from py_readpaper import find_author1
         p["author1"] = [ find_author1(x) for x in p['author'].values ]
     else:
         p["author"] = ''
@@ -199,24 +334,361 @@ def compare_bib_dict(item1, item2):
     return score
 
 
-def merge_items(pd_db, idx1, idx2, debug=False):
+# compare_bib_dict rules as tables for vectorized scoring
+uid_columns = ["doi", "pmid", "pmcid", "title", "local-url"]
+score_columns = [("year", 0.2), ("author", 0.2), ("author1", 0.1), ("journal", 0.2), ("volume", 0.1)]
+
+# identifiers of different papers: pairs and clusters with different values are not merged
+id_columns = ["doi", "pmid", "pmcid"]
+
+# any pair scoring above 0.5 shares one of these keys
+block_columns = [("year", "author1"), ("year", "author"), ("year", "journal"), ("author", "journal")]
+
+
+def normalize_title(title):
+    """ lowercase title with only letters and digits """
+
+    return re.sub(r'[^a-z0-9]', '', str(title).lower())
+
+
+def _block_pairs(codes):
+    """ all pairs of positions with the same key code (-1: no key) """
+
+    order = np.argsort(codes, kind='stable')
+    sc = codes[order]
+    starts = np.flatnonzero(np.r_[True, sc[1:] != sc[:-1]])
+    sizes = np.diff(np.r_[starts, len(sc)])
+
+    I, J = [], []
+    for s, k in zip(starts[sizes > 1], sizes[sizes > 1]):
+        if sc[s] == -1:
+            continue
+        a, b = np.triu_indices(k, 1)
+        I.append(order[s + a])
+        J.append(order[s + b])
+
+    if len(I) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(I), np.concatenate(J)
+
+
+def candidate_pairs(pd_db):
+    """ positions of record pairs sharing an identifier, title or block key """
+
+    def _col(c):
+        return pd_db[c].fillna('').astype(str)
+
+    keys = [ _col(c) for c in uid_columns if c in pd_db.columns ]
+    if 'title' in pd_db.columns:
+        keys.append(pd.Series([ normalize_title(x) for x in pd_db['title'].fillna('') ], index=pd_db.index))
+
+    for cols in block_columns:
+        if not all([ c in pd_db.columns for c in cols ]):
+            continue
+        parts = [ _col(c) for c in cols ]
+        key = parts[0]
+        empty = parts[0] == ''
+        for v in parts[1:]:
+            key = key + '\x1f' + v
+            empty = empty | (v == '')
+        keys.append(key.where(~empty, ''))
+
+    I, J = [], []
+    for k in keys:
+        codes, _ = pd.factorize(k)
+        codes[np.asarray(k == '', dtype=bool)] = -1
+        i, j = _block_pairs(codes)
+        I.append(np.minimum(i, j))
+        J.append(np.maximum(i, j))
+
+    if len(I) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    pairs = np.unique(np.stack([np.concatenate(I), np.concatenate(J)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def score_pairs(pd_db, I, J):
+    """ compare_bib_dict score of record pairs at positions I, J """
+
+    score = np.zeros(len(I))
+    unique = np.zeros(len(I), dtype=bool)
+
+    for c in uid_columns:
+        if c not in pd_db.columns:
+            continue
+        v = pd_db[c].to_numpy(dtype=object)
+        unique |= (v[I] != '') & (v[I] == v[J])
+
+    for c, s in score_columns:
+        if c not in pd_db.columns:
+            continue
+        v = pd_db[c].to_numpy(dtype=object)
+        score = score + np.where((v[I] != '') & (v[I] == v[J]), s, 0.0)
+
+    return np.where(unique, 1.0, score)
+
+
+def id_conflict(pd_db, I, J):
+    """ pairs at positions I, J with different doi, pmid or pmcid (different papers, e.g. Part I and Part II) """
+
+    conflict = np.zeros(len(I), dtype=bool)
+    for v in _id_values(pd_db):
+        conflict |= (v[I] != '') & (v[J] != '') & (v[I] != v[J])
+
+    return conflict
+
+
+def _id_values(pd_db):
+    """ identifier columns as object arrays ('' for missing) """
+
+    return [ pd_db[c].fillna('').astype(str).to_numpy(dtype=object) for c in id_columns if c in pd_db.columns ]
+
+
+def _clusters(n, I, J, ids=None):
+    """ connected components of pairs as lists of positions
+    (ids: identifier arrays, components with different identifiers are not joined) """
+
+    parent = np.arange(n)
+    ids = [ v.copy() for v in ids ] if ids is not None else []
+
+    def _find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in zip(I, J):
+        ri, rj = _find(i), _find(j)
+        if ri == rj:
+            continue
+        if any([ (v[ri] != '') and (v[rj] != '') and (v[ri] != v[rj]) for v in ids ]):
+            continue
+        root, other = min(ri, rj), max(ri, rj)
+        parent[other] = root
+        for v in ids:
+            if v[root] == '':
+                v[root] = v[other]
+
+    groups = {}
+    for i in np.unique(np.r_[I, J]):
+        groups.setdefault(_find(i), []).append(i)
+
+    return sorted([ g for g in groups.values() if len(g) > 1 ])
+
+
+def find_duplicates(pd_db, threshold=0.5, pairs=False, debug=False):
+    """ find duplicated items in whole db and return clusters of index """
+
+    I, J = candidate_pairs(pd_db)
+    score = score_pairs(pd_db, I, J)
+
+    sel = score > threshold
+    I, J, score = I[sel], J[sel], score[sel]
+    if debug: print('... {} duplicated pairs'.format(len(I)))
+
+    if pairs:
+        return pd.DataFrame({'idx1': pd_db.index[I], 'idx2': pd_db.index[J], 'score': score})
+
+    return [ list(pd_db.index[c]) for c in _clusters(len(pd_db), I, J, ids=_id_values(pd_db)) ]
+
+
+_minhash_empty = np.uint64(2**32)
+
+
+def _shingles(titles, authors, k=3):
+    """ character k-grams of normalized titles and first author hash as (record, value) arrays """
+
+    norm = [ normalize_title(t) for t in titles ]
+    lens = np.array([ len(t) for t in norm ], dtype=np.int64)
+    counts = np.maximum(lens - k + 1, 0)
+
+    # k-gram of ascii letters and digits packed into one integer
+    buf = np.frombuffer(''.join(norm).encode('ascii'), dtype=np.uint8).astype(np.uint64)
+    offset = np.repeat(np.cumsum(lens) - lens, counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = offset + within
+    grams = np.zeros(len(starts), dtype=np.uint64)
+    for i in range(k):
+        grams = (grams << np.uint64(8)) | buf[starts + i]
+
+    has = np.flatnonzero(counts > 0)
+    au = np.array([ zlib.crc32(('@' + str(authors[i]).lower()).encode('utf-8')) for i in has ], dtype=np.uint64)
+
+    rec = np.concatenate([np.repeat(np.arange(len(norm)), counts), has])
+    val = np.concatenate([grams, au | np.uint64(2**32)])
+    order = np.argsort(rec, kind='stable')
+
+    return rec[order], val[order]
+
+
+def minhash_signatures(pd_db, num_perm=64, seed=0):
+    """ MinHash signatures of title and author1 shingles (empty title: 2**32) """
+
+    # multiply-shift hash functions of shingle values
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2**63 - 1, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.randint(0, 2**63 - 1, size=num_perm, dtype=np.uint64)
+
+    titles = pd_db['title'].fillna('').values if 'title' in pd_db.columns else [''] * len(pd_db)
+    authors = pd_db['author1'].fillna('').values if 'author1' in pd_db.columns else [''] * len(pd_db)
+
+    rec, val = _shingles(titles, authors)
+    sig = np.full((num_perm, len(pd_db)), _minhash_empty, dtype=np.uint64)
+
+    # hash shingles of many records at once and take minimum per record
+    bounds = np.searchsorted(rec, np.arange(0, len(pd_db) + 2000, 2000))
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        if s == e:
+            continue
+        r = rec[s:e]
+        first = np.flatnonzero(np.r_[True, r[1:] != r[:-1]])
+        h = (np.outer(a, val[s:e]) + b[:, None]) >> np.uint64(32)
+        sig[:, r[first]] = np.minimum.reduceat(h, first, axis=1)
+
+    return np.ascontiguousarray(sig.T)
+
+
+def near_duplicates(pd_db, threshold=0.8, num_perm=64, bands=16, seed=0, debug=False):
+    """ similar title pairs using MinHash and LSH buckets """
+
+    sig = minhash_signatures(pd_db, num_perm=num_perm, seed=seed)
+    valid = sig[:, 0] != _minhash_empty
+    r = num_perm // bands
+
+    # one bucket key per band
+    mix = np.random.RandomState(seed + 1).randint(1, 2**63 - 1, size=r, dtype=np.uint64) | np.uint64(1)
+
+    I, J = [], []
+    for k in range(bands):
+        key = (sig[:, k*r:(k+1)*r] * mix).sum(axis=1)
+        codes, _ = pd.factorize(key)
+        codes[~valid] = -1
+        i, j = _block_pairs(codes)
+        I.append(np.minimum(i, j))
+        J.append(np.maximum(i, j))
+
+    if sum([ len(i) for i in I ]) == 0:
+        return pd.DataFrame({'idx1': [], 'idx2': [], 'similarity': []})
+
+    pairs = np.unique(np.stack([np.concatenate(I), np.concatenate(J)], axis=1), axis=0)
+    I, J = pairs[:, 0], pairs[:, 1]
+    sim = np.zeros(len(I))
+    for k in range(0, len(I), 100000):
+        sim[k:k+100000] = (sig[I[k:k+100000]] == sig[J[k:k+100000]]).mean(axis=1)
+
+    sel = sim >= threshold
+    if debug: print('... {} candidates, {} similar pairs'.format(len(I), sel.sum()))
+
+    return pd.DataFrame({'idx1': pd_db.index[I[sel]], 'idx2': pd_db.index[J[sel]], 'similarity': sim[sel]})
+
+
+def pair_clusters(pd_db, pairs):
+    """ clusters of index connected by (idx1, idx2) pairs """
+
+    I = pd_db.index.get_indexer(pairs['idx1'])
+    J = pd_db.index.get_indexer(pairs['idx2'])
+
+    return [ list(pd_db.index[c]) for c in _clusters(len(pd_db), I, J, ids=_id_values(pd_db)) ]
+
+
+def _url_list(x):
+    """ other-urls value as list """
+
+    if isinstance(x, (list, tuple)) or hasattr(x, 'tolist'):
+        return [ str(u) for u in list(x) ]
+    return []
+
+
+def merge_clusters(pd_db, clusters, debug=False):
+    """ merge each cluster of index into its first item and drop the others at once """
+
+    prim, sec = [], []
+    for c in clusters:
+        prim.extend([c[0]] * (len(c) - 1))
+        sec.extend(c[1:])
+
+    report = pd.DataFrame({'idx': [ c[0] for c in clusters if len(c) > 1 ],
+                           'merged': [ list(c[1:]) for c in clusters if len(c) > 1 ]})
+    report['filled'] = [ [] for _ in range(len(report)) ]
+    if len(sec) == 0:
+        return pd_db, report
+
+    src = pd_db.loc[sec]
+    out = pd_db.drop(index=sec)
+    filled = { p: f for p, f in zip(report['idx'], report['filled']) }
+
+    # keep files of secondary items on primary item (sync does not read them as new papers)
+    if 'local-url' in out.columns:
+        urls = {}
+        for p, s in zip(prim, sec):
+            urls.setdefault(p, []).extend([src.at[s, 'local-url']] + _url_list(src.at[s, 'other-urls'] if 'other-urls' in src.columns else []))
+        other = [ _url_list(x) for x in out['other-urls'] ] if 'other-urls' in out.columns else [ [] for _ in range(len(out)) ]
+        for i, p in zip(out.index.get_indexer(list(urls.keys())), urls.keys()):
+            other[i] = other[i] + [ u for u in urls[p] if u not in ['', 'nan'] ]
+        out['other-urls'] = other
+
+    for col in out.columns:
+        if pd.api.types.is_numeric_dtype(out[col]) or pd.api.types.is_bool_dtype(out[col]) or (col == 'other-urls'):
+            continue
+
+        # first non-empty value of secondary items for each primary item
+        v = pd.Series(src[col].values, index=prim)
+        v = v[~(v.isna() | (v.astype(str) == ''))]
+        v = v[~v.index.duplicated(keep='first')]
+
+        target = v.index[(out.loc[v.index, col] == '').values]
+        if len(target) == 0:
+            continue
+
+        out.loc[target, col] = v[target].values
+        for p in target:
+            filled[p].append(col)
+
+    if debug:
+        print('... merged {} items into {} items'.format(len(sec), len(report)))
+
+    return out, report
+
+
+def merge_pairs(pd_db, pairs, min_score=0.5, report=False, debug=False):
+    """ merge (idx1, idx2) pairs scoring min_score or more and without id_conflict, keeping the first record
+    (report: also return merge report) """
+
+    I = pd_db.index.get_indexer(pairs['idx1'])
+    J = pd_db.index.get_indexer(pairs['idx2'])
+    score = score_pairs(pd_db, I, J)
+    sel = (score >= min_score) & (~id_conflict(pd_db, I, J))
+
+    if debug: print('... {}/{} pairs have score >= {}'.format(sel.sum(), len(score), min_score))
+
+    pd_db, merged = merge_clusters(pd_db, pair_clusters(pd_db, pairs[sel]), debug=debug)
+    if report:
+        return pd_db, merged
+
+    print('... merged {} items'.format(sum([ len(x) for x in merged['merged'] ])))
+    return pd_db
+
+
+def merge_items(pd_db, idx1, idx2, min_score=0.8, debug=False):
     """ merge two items in pd db """
 
     if idx1 == idx2: return (False, pd_db)
 
     score = compare_bib_dict(pd_db.loc[idx1], pd_db.loc[idx2])
 
-    if score < 0.8:
+    if id_conflict(pd_db, pd_db.index.get_indexer([idx1]), pd_db.index.get_indexer([idx2]))[0]:
+        print('... two entries ({}, {}) have different identifiers'.format(idx1, idx2))
+        return (False, pd_db)
+
+    if score < min_score:
         print('... two entries ({}, {}) are different: {}'.format(idx1, idx2, score))
         if debug: print(pd_db.loc[[idx1, idx2]])
         return (False, pd_db)
 
-    for col in pd_db.columns:
-        if pd_db.loc[idx1, col] is '':
-            pd_db.loc[idx1, col] = pd_db.loc[idx2, col]
-
     if debug:
         print('... ({}, {}) are merged: {}'.format(idx1, idx2, score))
         print(pd_db.loc[[idx1, idx2]])
 
-    return (True, pd_db.drop([idx2]))
+    pd_db, _ = merge_clusters(pd_db, [[idx1, idx2]])
+    return (True, pd_db)
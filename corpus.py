@@ -0,0 +1,126 @@
+"""
+corpus.py
+
+cache of cleaned paper text for tf-idf
+"""
+
+import os
+import re
+import zlib
+import sqlite3
+
+import filedb
+
+
+# ip addresses, urls and publisher names removed from text
+_clean_re = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+                       r'|(http://.*?\s)|(http://.*)'
+                       '|royalsocietypublishing|annualreviews|science reports|nature publishing group')
+
+
+def clean_text(txt):
+    """ remove line breaks, ip addresses, urls and publisher names """
+
+    return _clean_re.sub('', str(txt).replace('\n', ' '))
+
+
+def read_text(fname, debug=False):
+    """ abstract and contents of pdf file (None if not readable) """
+
+    from py_readpaper import Paper
+
+    try:
+        p = Paper(fname, exif=False, debug=debug)
+        return '{}\n{}'.format(p.abstract(), p.contents(split=False, update=False))
+    except Exception:
+        print('... error reading: {}'.format(fname))
+        return None
+
+
+def iter_corpus(fnames, cache=None, debug=False):
+    """ yield cleaned text of each file, from cache or pdf """
+
+    for fname in fnames:
+        txt = None if cache is None else cache.get(fname)
+        if txt is None:
+            raw = read_text(fname, debug=debug)
+            if raw is None:
+                yield ''
+                continue
+            txt = clean_text(raw)
+            if cache is not None:
+                cache.put(fname, txt)
+        yield txt
+
+
+def _stat(path):
+    """ (mtime, size, bib mtime) of pdf file """
+
+    st = os.stat(path)
+    try:
+        bib_mtime = os.stat(filedb.bib_filename(path)).st_mtime_ns
+    except OSError:
+        bib_mtime = 0
+
+    return st.st_mtime_ns, st.st_size, bib_mtime
+
+
+class TextCache(object):
+    """ compressed cleaned text in one sqlite file, keyed by path, mtime and size """
+
+    def __init__(self, filename='./corpus.sqlite'):
+        """ open cache file """
+
+        self._conn = sqlite3.connect(filename)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS texts (path TEXT PRIMARY KEY, '
+                           'mtime INTEGER, size INTEGER, bib_mtime INTEGER, text BLOB)')
+        self._pending = 0
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM texts').fetchone()[0]
+
+    def get(self, path):
+        """ cached text of path or None if missing or changed """
+
+        row = self._conn.execute('SELECT mtime, size, bib_mtime, text FROM texts WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return None
+
+        try:
+            if tuple(row[:3]) != _stat(path):
+                return None
+        except OSError:
+            return None
+
+        return zlib.decompress(row[3]).decode('utf-8')
+
+    def put(self, path, text):
+        """ store text of path with current file stat """
+
+        mtime, size, bib_mtime = _stat(path)
+        self._conn.execute('INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?, ?)',
+                           (path, mtime, size, bib_mtime, zlib.compress(text.encode('utf-8'))))
+
+        self._pending += 1
+        if self._pending >= 100:
+            self.commit()
+
+    def prune(self, paths):
+        """ remove texts of files not in paths """
+
+        keep = set(paths)
+        old = [ (p,) for (p,) in self._conn.execute('SELECT path FROM texts') if p not in keep ]
+        self._conn.executemany('DELETE FROM texts WHERE path=?', old)
+        self.commit()
+
+    def commit(self):
+        """ write pending texts """
+
+        self._conn.commit()
+        self._pending = 0
+
+    def close(self):
+        """ commit and close cache file """
+
+        self.commit()
+        self._conn.close()
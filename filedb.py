@@ -8,19 +8,51 @@ import os
 import datetime
 import platform
 import glob
+import functools
+import concurrent.futures
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
-
-from py_readpaper import Paper
 
 
 # file db structure
 # local-url, year, author1, journal, title, doi, keywords, abstract, extra, sync
 
-def read_dir(dirname='.', debug=False):
-    """ from file list and filenames build panda db not using Paper library (fast) """
+col_list = ["author", "author1", "journal", "title", "doi", "pmid", "pmcid", "abstract" ]
 
-    flist = sorted(glob.glob(dirname + '/*.pdf'))
+# YEAR-AUTHOR-JOURNAL[-1..5].pdf
+fname_re = r'^(?P<year>\d+)-(?P<author1>[^-]*)-(?P<journal>.*?)(?:-(?P<extra>[1-5]))?$'
+
+
+def parse_fnames(flist):
+    """ split file names into year, author1, journal and extra (NaN for wrong names) """
+
+    cols = ['year', 'author1', 'journal', 'extra']
+
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        pa = None
+
+    if pa is not None:
+        names = pc.replace_substring(pc.replace_substring_regex(pa.array(flist, type=pa.string()), '^.*/', ''), '.pdf', '')
+        s = pc.extract_regex(names, fname_re)
+        parts = pd.DataFrame({ c: a.to_pandas().astype(object) for c, a in zip(cols, s.flatten()) })
+    else:
+        names = pd.Series(flist, dtype=object).str.replace(r'^.*/', '', regex=True).str.replace('.pdf', '', regex=False)
+        parts = names.str.extract(fname_re).astype(object)
+        parts.loc[parts['year'].notna(), 'extra'] = parts['extra'].fillna('')
+
+    parts.index = range(len(parts))
+    return parts.where(parts.notna(), np.nan)
+
+
+def read_dir(dirname='.', debug=False, flist=None, rejects=False):
+    """ from file list and filenames build panda db not using Paper library (fast)
+    (wrong names are kept with year 0, rejects: also return them as table) """
+
+    if flist is None:
+        flist = sorted(glob.glob(dirname + '/*.pdf'))
     if len(flist) == 0:
         print('... no pdf files in {}'.format(dirname))
         return
@@ -31,100 +63,172 @@ def read_dir(dirname='.', debug=False):
     db = pd.DataFrame(columns=colnames)
     db['local-url'] = flist
 
-    years = []
-    authors_s = []
-    journals = []
-    extras = []
-    skip = False
-
     # file name check
-    for f in flist:
-        fname = f.split('/')[-1]
-        tmp = fname.replace('.pdf','').split('-')
-        extra = ''
-
-        if len(tmp) < 3:
-            print('... change fname: YEAR-AUTHOR-JOURNAL {}'.format(fname))
-            skip = True
-        elif len(tmp) > 3:
-            if debug: print('... warning fname: YEAR-AUTHOR-JOURNAL {}'.format(fname))
-
-            if tmp[-1] in ['1', '2', '3', '4', '5']:      # check duplicated same name, same journal, same year
-                tmp[2] = '-'.join(tmp[2:-1])
-                extra = tmp[-1]
-                if debug: print('{} | {} | {} | {}'.format(tmp[0], tmp[1].replace('_', '-'), tmp[2].replace('_', ' '), extra))
-            else:
-                tmp[2] = '-'.join(tmp[2:])
-                if debug: print('{} | {} | {}'.format(tmp[0], tmp[1].replace('_', '-'), tmp[2].replace('_', ' ')))
-
-        if not skip:
-            years.append(int(tmp[0]))
-            authors_s.append(tmp[1].replace('_', '-'))
-            journals.append(tmp[2].replace('_', ' '))
-            extras.append(extra)
-
-    db['year'] = years
-    db['author1'] = authors_s
-    db['journal'] = journals
-    db['extra'] = extras
-
+    parts = parse_fnames(flist)
+    bad = parts['year'].isna()
+    for f in db.loc[bad, 'local-url']:
+        print('... change fname: YEAR-AUTHOR-JOURNAL {}'.format(f.split('/')[-1]))
+    if debug:
+        print('... {} files with extra name parts'.format((parts['extra'].fillna('') != '').sum()))
+
+    db['year'] = parts['year'].fillna('0').astype(int)
+    db['author1'] = parts['author1'].fillna('').str.replace('_', '-', regex=False)
+    db['journal'] = parts['journal'].fillna('').str.replace('_', ' ', regex=False)
+    db['extra'] = parts['extra'].fillna('')
+
+    if rejects:
+        return db, db.loc[bad, ['local-url']].assign(reason='not YEAR-AUTHOR-JOURNAL')
     return db
 
 
-def build_filedb(dirname='.', debug=False):
-    """ create database from pdf files """
+def read_paper(fname, debug=False):
+    """ read metadata of one pdf file and return plain dict """
+
+    from py_readpaper import Paper
+
+    paper = Paper(fname, debug=debug, exif=False)
+
+    item = {}
+    for c in col_list:
+        item[c] = paper._bib.get(c, '')
+
+    item["year"] = paper._bib.get("year", 0)
+    item["keywords"] = paper._bib.get("keywords", [])
+    item["rating"] = paper._bib.get("rating", 0)
+    item["has_bib"] = paper._exist_bib
+    item["import_date"] = datetime.datetime.fromtimestamp(os.path.getmtime(fname))
+    #item["gensim"] = paper.keywords_gensim()
+    #item["sync"] = True
+
+    return item
 
-    fdb = read_dir(dirname)
 
-    col_list = ["author", "author1", "journal", "title", "doi", "pmid", "pmcid", "abstract" ]
+def read_papers(flist, workers=1, debug=False):
+    """ read metadata of pdf files in order, using process pool if workers > 1 """
 
-    for i in tqdm(fdb.index):
-        paper = Paper(fdb.at[i, "local-url"], debug=debug, exif=False)
+    from tqdm import tqdm
 
-        for c in col_list:
-            fdb.at[i, c] = paper._bib.get(c, '')
+    if workers > 1 and len(flist) > 1:
+        chunksize = max(1, len(flist) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as ex:
+            items = list(tqdm(ex.map(functools.partial(read_paper, debug=debug), flist, chunksize=chunksize), total=len(flist)))
+    else:
+        items = [ read_paper(f, debug=debug) for f in tqdm(flist) ]
+
+    return items
+
+
+def build_filedb(dirname='.', workers=1, debug=False, flist=None, items=None):
+    """ create database from pdf files (items: read_paper results of flist already read) """
 
-        fdb.at[i, "year"] = paper._bib.get("year", 0)
-        fdb.at[i, "keywords"] = paper._bib.get("keywords", [])
-        fdb.at[i, "rating"] = paper._bib.get("rating", 0)
-        fdb.at[i, "has_bib"] = paper._exist_bib
-        fdb.at[i, "import_date"] = datetime.datetime.fromtimestamp(os.path.getmtime(fdb.at[i, "local-url"]))
-        #fdb.at[i, "gensim"] = paper.keywords_gensim()
-        #fdb.at[i, "sync"] = True
+    fdb = read_dir(dirname, flist=flist)
+
+    if items is None:
+        items = read_papers(list(fdb["local-url"]), workers=workers, debug=debug)
+
+    # write all columns in one step
+    for c in col_list + ["year", "keywords", "rating", "has_bib", "import_date"]:
+        fdb[c] = [ item[c] for item in items ]
 
     return fdb
 
 
-def update_filedb(fdb, filename, debug=False):
-    """ update filedb for one file """
+def update_filedb(fdb, filename, index=None, debug=False):
+    """ update filedb for one file (index: query.KeyIndex of fdb) """
 
-    find_file = fdb[fdb['local-url'] == filename]
+    if index is None:
+        find_file = fdb[fdb['local-url'] == filename].index
+    else:
+        find_file = index.get('local-url', filename)
 
     if len(find_file) == 0:
         print('... can not find file: {}'.format(filename))
         return
 
-    idx = find_file.index[0]
-    if debug: print(fdb.iloc[idx])
+    idx = find_file[0]
+    if debug: print(fdb.loc[idx])
 
-    paper = Paper(fdb.at[idx, "local-url"], debug=debug, exif=False)
+    item = read_paper(fdb.at[idx, "local-url"], debug=debug)
+    for c, v in item.items():
+        fdb.at[idx, c] = v
 
-    col_list = ["author", "author1", "journal", "title", "doi", "pmid", "pmcid", "abstract" ]
-    for c in col_list:
-        fdb.at[idx, c] = paper._bib.get(c, '')
+    return fdb
 
-    fdb.at[idx, "year"] = paper._bib.get("year", 0)
-    fdb.at[idx, "keywords"] = paper._bib.get("keywords", [])
-    fdb.at[idx, "rating"] = paper._bib.get("rating", 0)
-    fdb.at[idx, "has_bib"] = paper._exist_bib
-    fdb.at[idx, "import_date"] = datetime.datetime.fromtimestamp(os.path.getmtime(paper._fname))
 
-    return fdb
+def bib_filename(filename):
+    """ return hidden bib file name of pdf file """
+
+    base, fname = os.path.split(filename)
+    return os.path.join(base, '.' + fname.replace('.pdf', '.bib'))
+
+
+def file_fingerprints(flist):
+    """ collect size, mtime and bib mtime of pdf files """
+
+    rows = []
+    for f in flist:
+        st = os.stat(f)
+        try:
+            bib_mtime = os.stat(bib_filename(f)).st_mtime_ns
+        except OSError:
+            bib_mtime = 0
+        rows.append((f, st.st_size, st.st_mtime_ns, bib_mtime))
+
+    fp = pd.DataFrame(rows, columns=['local-url', 'size', 'mtime', 'bib_mtime'])
+    return fp.set_index('local-url')
+
+
+def diff_filedb(fdb, fingerprints, dirname='.'):
+    """ added or changed pdf files, index of records of deleted files and new fingerprints """
+
+    flist = sorted(glob.glob(dirname + '/*.pdf'))
+    new_fp = file_fingerprints(flist)
+
+    if fingerprints is None:
+        fingerprints = new_fp.iloc[:0]
+
+    # files whose fingerprint is new or differs from the saved one
+    old_fp = fingerprints.reindex(new_fp.index)
+    changed = (old_fp != new_fp).any(axis=1)
+    changed = changed | (~new_fp.index.isin(fdb['local-url']))
+
+    # files of records merged into other records by dedup
+    merged = set()
+    if 'other-urls' in fdb.columns:
+        for urls in fdb['other-urls']:
+            if isinstance(urls, (list, tuple)) or hasattr(urls, 'tolist'):
+                merged.update(list(urls))
+    changed = changed & (~new_fp.index.isin(list(merged)))
+    changed_flist = list(new_fp.index[changed])
+
+    deleted = fdb.index[~fdb['local-url'].isin(new_fp.index)]
+    unchanged = len(fdb) - len(deleted) - fdb['local-url'].isin(changed_flist).sum()
+
+    print('... sync {}: {} added/changed, {} deleted, {} unchanged'.format(dirname, len(changed_flist), len(deleted), unchanged))
+
+    return changed_flist, list(deleted), new_fp
+
+
+def sync_filedb(fdb, fingerprints, dirname='.', workers=1, debug=False):
+    """ re-read only added or changed pdf files and drop deleted ones """
+
+    changed_flist, deleted, new_fp = diff_filedb(fdb, fingerprints, dirname=dirname)
+    keep = ~(fdb.index.isin(deleted) | fdb['local-url'].isin(changed_flist))
+
+    if len(changed_flist) > 0:
+        new_db = build_filedb(dirname=dirname, workers=workers, debug=debug, flist=changed_flist)
+        fdb = pd.concat([fdb[keep], new_db], ignore_index=True, sort=False)
+    else:
+        fdb = fdb[keep]
+
+    return fdb, new_fp
 
 
 def check_files(dirname='.', globpattern='*.pdf', count=False, debug=False):
     """ check pdf files and match bib data """
 
+    from py_readpaper import Paper
+
     flist = glob.glob(dirname + '/' + globpattern)
 
     missing_flist = []
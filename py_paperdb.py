@@ -3,50 +3,83 @@
 import pandas as pd
 import numpy as np
 import os
-import re
-import tqdm
+import glob
 import pickle
 import subprocess
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.decomposition import LatentDirichletAllocation
-
-from py_readpaper import Paper
-
 import bibdb
 import filedb
+import storage
+import textindex
+import query
+import recommender
+import corpus
 
 from utils import safe_pickle_dump
 
 class PaperDB(object):
     """ paper database using pandas """
 
-    def __init__(self, dirname='.', cache=True, debug=False):
+    def __init__(self, dirname='.', cache=True, workers=1, engine=None, debug=False):
         """ initialize database """
 
+        if engine is None:
+            engine = storage.default_engine()
+
         self._debug = debug
         self._dirname = dirname
-        self._bibfilename = '.paperdb.csv'
+        self._workers = workers
+        self._engine = engine
+        self._bibfilename = storage.db_filename(engine)
+        self._fpfname = '.paperdb.fp.csv'
         self._metafname = './meta.p'
         self._tfidfname = './tfidf.p'
-        self._simfname = './sim.p'
+        self._simfname = './sim_index.npy'
+        self._simscorefname = './sim_score.npy'
+        self._oldsimfname = './sim.p'
         self._ldafname = './lda.p'
+        self._indexfname = './index.npz'
+        self._indexchangesfname = './index.changes.p'
+        self._annfname = './ann.p'
+        self._corpusfname = './corpus.sqlite'
         self._currentpaper = ''
         self._updated = False
-        self._sim_dict = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._rev = 0               # sqlite revision of records in memory
+        self._revs = set()          # sqlite revisions written by row updates of this session
+        self._sim = None
+        self._X = None
+        self._ann = None
+        self._vectorizer = None
+        self._paths = None          # local-url of each row in feature matrix
+        self._rowof = None
+        self._nfit = 0              # number of papers in last vectorizer fit
         self._vocab = {}
         self._idf = []
+        self._lda = []
+        self._topics = []
+        self._ldamodel = None
+        self._ldapaths = []
         self._selection = set()
-
-        if cache and os.path.exists(self._bibfilename):
-            p = pd.read_csv(self._bibfilename, index_col=0)
-            self._bibdb = bibdb.clean_db(p)
-            if debug: print('... read from {}'.format(self._bibfilename))
+        self._textindex = None
+        self._engine_cache = None
+        self._keys = None
+
+        # read old csv database when there is no database in this engine
+        dbfname = self._bibfilename
+        if (not os.path.exists(dbfname)) and os.path.exists(storage.db_filename('csv')):
+            dbfname = storage.db_filename('csv')
+
+        if os.path.exists(dbfname) and (cache or os.path.exists(self._fpfname)):
+            self._rev = storage.db_revision(dbfname)
+            self._bibdb = storage.read_db(dbfname)
+            self._updated = (dbfname != self._bibfilename)
+            if debug: print('... read from {}'.format(dbfname))
+            if not cache:
+                self.sync()
         else:
-            p = filedb.build_filedb(dirname=dirname, debug=debug)
-            self._bibdb = bibdb.clean_db(p)
-            self._bibdb.to_csv(self._bibfilename)
-            if debug: print('... save to {}'.format(self._bibfilename))
+            self.reload(update=False)
 
     # view database
 
@@ -77,7 +110,8 @@ class PaperDB(object):
     def search_sep(self, year=0, author='', journal='', author1='', title='', doi=''):
         """ search database by separate search keywords """
 
-        res = search(self._bibdb, year=year, author=author, journal=journal, author1=author1, title=title, doi=doi)
+        idx = self.search_engine().search(year=year, author=author, journal=journal, author1=author1, title=title, doi=doi)
+        res = self._bibdb.loc[idx]
 
         if len(res.index) > 0:
             if len(res.index) > 10:
@@ -92,29 +126,93 @@ class PaperDB(object):
         return quickview(res)
 
     def search_all(self, sstr=None, columns=None):
-        """ search searchword for all database """
+        """ search searchword for all database (token index query unless columns are given) """
 
         if sstr is None:
             print('... add search string')
             os.exit(1)
-        if columns is None:
-            columns = ['title', 'abstract', 'author', 'keywords', 'doi', 'local-url']
-        if 'keywords' in columns:
-            self._bibdb['keywords_csv'] = [ ','.join(x) for x in self._bibdb['keywords'] ]
-            columns.remove('keywords')
-            columns.append('keywords_csv')
 
-        sindex = []
-        for c in columns:
-            res = self._bibdb[self._bibdb[c].str.contains(sstr)].index
-            if len(res) > 0:
-                sindex.extend(res)
+        if columns is None:
+            sindex = self.text_index().query(sstr)
+        else:
+            sindex = []
+            for c in columns:
+                if c == 'keywords':
+                    values = pd.Series([ ','.join(x) for x in self._bibdb['keywords'] ], index=self._bibdb.index)
+                else:
+                    values = self._bibdb[c]
+                res = self._bibdb[values.str.contains(sstr)].index
+                if len(res) > 0:
+                    sindex.extend(res)
 
         if len(sindex) > 0:
             sindex = sorted(list(set(sindex)))
             self._selection = self._selection.union(set(sindex))
 
-            return quickview(self._bibdb.iloc[sindex])
+            return quickview(self._bibdb.loc[sindex])
+
+    def search_engine(self):
+        """ precomputed search columns of bibdb """
+
+        if self._engine_cache is None:
+            self._engine_cache = query.SearchEngine(self._bibdb)
+
+        return self._engine_cache
+
+    def key_index(self):
+        """ dict indexes of doi, pmid, pmcid and local-url """
+
+        if self._keys is None:
+            self._keys = query.KeyIndex(self._bibdb)
+
+        return self._keys
+
+    def text_index(self, update=False):
+        """ read or build inverted index for search_all """
+
+        if (self._textindex is not None) and (not update):
+            return self._textindex
+
+        # index file does not follow renumbered records before they are saved
+        mtime = max([ os.path.getmtime(f) for f in [self._indexfname, self._indexchangesfname] if os.path.exists(f) ] or [0])
+        fresh = os.path.exists(self._indexfname) and os.path.exists(self._bibfilename) and \
+                (mtime >= os.path.getmtime(self._bibfilename)) and (not self._updated)
+
+        if fresh and (not update):
+            if self._debug: print('... read from {}'.format(self._indexfname))
+            self._textindex = textindex.TextIndex.load(self._indexfname, self._indexchangesfname)
+        else:
+            if self._debug: print('... build text index')
+            self._textindex = textindex.TextIndex().build(self._bibdb)
+            # index file follows the saved database
+            if not (self._updated or len(self._dirty) + len(self._deleted) > 0):
+                self._save_index()
+
+        return self._textindex
+
+    def _save_index(self):
+        """ save inverted index next to database (only changed records while they are few) """
+
+        ti = self._textindex
+        if ti is None:
+            return
+
+        if ti._saved and (ti.changes() <= max(1000, len(ti) // 10)):
+            if self._debug: print('... writing: {}'.format(self._indexchangesfname))
+            ti.save_changes(self._indexchangesfname)
+            return
+
+        if self._debug: print('... writing: {}'.format(self._indexfname))
+        self._drop_index()
+        ti.compact()
+        ti.save(self._indexfname)
+
+    def _drop_index(self):
+        """ remove index files """
+
+        for f in [self._indexchangesfname, self._indexfname]:
+            if os.path.exists(f):
+                os.remove(f)
 
     def search_wrongname(self, columns=['doi', 'year', 'author1', 'journal']):
         """ find wrong file name from filedb """
@@ -129,7 +227,7 @@ class PaperDB(object):
 
         print('... total {}/{} incorrect papers'.format(len(sindex), len(self._bibdb)))
 
-        return quickview(self._bibdb.iloc[sindex])
+        return quickview(self._bibdb.loc[sindex])
 
     def search_new(self, n=10):
         """ print out recently added papers """
@@ -141,9 +239,9 @@ class PaperDB(object):
 
         s_db = self._bibdb
         if paper.doi() != '':
-            s_db = search(s_db, doi=paper.doi())
+            s_db = s_db.loc[self.key_index().get('doi', paper.doi())]
         elif paper.year() is not None:
-            s_db = search(s_db, year=int(paper.year()))
+            s_db = s_db.loc[self.search_engine().search(year=int(paper.year()))]
 
         #paper.bibtex()
 
@@ -161,8 +259,7 @@ class PaperDB(object):
             else:
                 item = paper._bib
 
-            self._bibdb = self._bibdb.append(item, ignore_index=True)
-            idx = len(self._bibdb) - 1
+            idx = self._append(item)
 
         # exact match
         if len(s_db) == 1:
@@ -170,16 +267,15 @@ class PaperDB(object):
             idx = s_db.index[0]
 
             if paper._bib is not None:
-                for keys in paper._bib.keys():
-                    self._bibdb.at[idx, keys] = paper._bib.get(keys)
+                self._set_record(idx, storage.normalize_db(pd.DataFrame([paper._bib])).iloc[0].to_dict())
 
         self._bibdb.at[idx, 'local-url'] = paper._fname
-        self._updated = True
+        self._touch(idx)
 
         if as_index:
             return idx
         else:
-            return quickview(self._bibdb.iloc[idx])
+            return quickview(self._bibdb.loc[idx])
 
     # selection operations
 
@@ -188,7 +284,7 @@ class PaperDB(object):
 
         if len(self._selection) > 0:
             if self._debug: print('... # of selection: {}'.format(len(self._selection)))
-            return quickview(self._bibdb.iloc[list(self._selection)])
+            return quickview(self._bibdb.loc[sorted(self._selection)])
 
     def selection_bibtex(self, n=-1):
         """ print bibtex items in selection """
@@ -226,6 +322,8 @@ class PaperDB(object):
     def paper(self, idx, exif=True):
         """ open pdf file in osx """
 
+        from py_readpaper import Paper
+
         try:
             filename = self._bibdb.at[idx, 'local-url']
             self._currentpaper = Paper(filename, exif=exif, debug=self._debug)
@@ -237,7 +335,7 @@ class PaperDB(object):
     def open(self, idx=-1):
         """ open pdf file in osx """
 
-        if isinstance(self.paper(idx), Paper):
+        if self.paper(idx) is not False:
             self._currentpaper.open()
         else:
             cmd = ["Open", self._bibfilename]
@@ -246,22 +344,22 @@ class PaperDB(object):
     def readpaper(self, idx=-1, n=10):
         """ open paper in text mode """
 
-        if isinstance(self.paper(idx), Paper):
+        if self.paper(idx) is not False:
             return self._currentpaper.head(n=n)
 
     def item(self, idx):
         """ show records in idx """
 
         # update using paper's information
-        if isinstance(self.paper(idx), Paper):
-            self._updated = True
+        if self.paper(idx) is not False:
             self._currentpaper.save_bib()
 
             for k, i in self._currentpaper._bib.items():
                 self._bibdb.at[idx, k] = i
             self._bibdb.at[idx, "has_bib"] = True
+            self._touch(idx)
 
-        return self._bibdb.iloc[idx]
+        return self._bibdb.loc[idx]
 
     # manage database
 
@@ -271,36 +369,277 @@ class PaperDB(object):
         if selection:
             if bibfilename is None:
                 bibfilename = 'selection.bib'
-            bibdb.to_bib(self._bibdb.iloc[list(self._selection)], bibfilename)
+            bibdb.to_bib(self._bibdb.loc[sorted(self._selection)], bibfilename)
             with open(bibfilename) as f:
                 print(f.readlines())
         else:
-            bibdb.to_bib(self._bibdb, self._bibfilename)
+            if bibfilename is None:
+                bibfilename = '.paperdb.bib'
+            bibdb.to_bib(self._bibdb, bibfilename)
+
+    def _append(self, item):
+        """ add one record at the end of bibdb """
+
+        return self._append_rows([item])[0]
+
+    def _append_rows(self, items):
+        """ add records at the end of bibdb in one concat (sqlite gives their ids) """
+
+        new = pd.DataFrame(items)
+        for k in new.columns:
+            if k not in self._bibdb.columns:
+                self._bibdb[k] = ''
+        new = storage.normalize_db(new.reindex(columns=self._bibdb.columns))
+
+        start = int(self._bibdb.index.max()) + 1 if len(self._bibdb) > 0 else 0
+        idxs = list(range(start, start + len(new)))
+
+        # ids are taken in the write transaction so that other sessions can not take them
+        if self._sqlite() and os.path.exists(self._bibfilename) and not self._updated:
+            rev, ids = storage.insert_db(new, self._bibfilename)
+            self._revs.add(rev)
+            if len(self._bibdb.index.intersection(ids)) == 0:
+                idxs = ids
+            else:
+                # records were renumbered by other session: write all records
+                self._updated = True
+
+        new.index = idxs
+        self._bibdb = pd.concat([self._bibdb, new])
+        return idxs
+
+    def _set_record(self, idx, item):
+        """ replace values of one record """
+
+        for k, v in item.items():
+            if k not in self._bibdb.columns:
+                self._bibdb[k] = ''
+            self._bibdb.at[idx, k] = v
+
+    def _sqlite(self):
+        return self._bibfilename.endswith('.sqlite')
+
+    def _merge_saved(self):
+        """ take records saved by other sessions since last read (sqlite) """
+
+        rev = storage.db_revision(self._bibfilename)
+        if rev <= self._rev:
+            return rev
+
+        theirs = storage.changed_db(self._bibfilename, self._rev, exclude=self._revs)
+        keys = self.key_index()
+        dirty = set(self._dirty)
+        new = []
+        for item in theirs.to_dict('records'):
+            found = []
+            for k in ['local-url', 'doi']:
+                if (len(found) == 0) and (item.get(k, '') != ''):
+                    found = keys.get(k, item[k])
+            if len(found) == 0:
+                new.append(item)
+            elif found[0] not in dirty:
+                self._set_record(found[0], item)
+                self._touch(found[0])
+
+        if len(new) > 0:
+            for idx in self._append_rows(new):
+                self._touch(idx)
+        if self._debug: print('... took {} records saved by other sessions'.format(len(theirs)))
+
+        self._rev = rev
+        return rev
+
+    def _save(self):
+        """ write all records or changed records """
+
+        if not self._sqlite():
+            storage.write_db(self._bibdb, self._bibfilename, rows=None if self._updated else self._dirty)
+            return
+
+        if not self._updated:
+            rev = storage.write_db(self._bibdb, self._bibfilename, rows=self._dirty, rev=self._rev, deleted=self._deleted)
+            if rev is not None:
+                self._revs.add(rev)
+                return
+            # records were renumbered by other session: write all records
+            self._updated = True
+
+        # keep records saved by other sessions while this session was open
+        rev = None
+        while rev is None:
+            since = self._merge_saved()
+            rev = storage.write_db(self._bibdb, self._bibfilename, rev=since)
+        self._rev = rev
+        self._revs = set()
+
+    def add_records(self, p):
+        """ add or replace records of pdf files (filedb rows) and save only these rows """
+
+        p = storage.normalize_db(p.copy())
+        keys = self.key_index()
+        idxs = []
+        new = []
+        for item in p.to_dict('records'):
+            found = keys.get('local-url', item['local-url'])
+            if len(found) > 0:
+                self._set_record(found[0], item)
+                idxs.append(found[0])
+            else:
+                new.append(item)
+                idxs.append(None)
+
+        # new records in one concat
+        if len(new) > 0:
+            added = iter(self._append_rows(new))
+            idxs = [ next(added) if idx is None else idx for idx in idxs ]
+
+        for idx in idxs:
+            self._touch(idx)
+
+        # remember fingerprints so that sync does not read these files again
+        fp = filedb.file_fingerprints(list(p['local-url']))
+        if os.path.exists(self._fpfname):
+            old = pd.read_csv(self._fpfname, index_col=0)
+            fp = pd.concat([old.drop(index=fp.index, errors='ignore'), fp])
+        fp.to_csv(self._fpfname)
+
+        self.update()
+        return idxs
+
+    def _reindex(self):
+        """ drop indexes after records are renumbered """
+
+        self._engine_cache = None
+        self._keys = None
+        self._textindex = None
+
+    def _drop(self, idxs):
+        """ remove records without renumbering the others """
+
+        idxs = set(idxs)
+        if len(idxs) == 0:
+            return
+
+        self._bibdb = self._bibdb.drop(index=list(idxs))
+        self._selection -= idxs
+        self._dirty -= idxs
+        self._deleted |= idxs
+        self._engine_cache = None
+        for i in idxs:
+            if self._keys is not None:
+                self._keys.remove(i)
+            if self._textindex is not None:
+                self._textindex.remove(i)
+
+    def _touch(self, idx):
+        """ mark changed record to save and update indexes """
+
+        self._dirty.add(idx)
+        if self._engine_cache is not None:
+            self._engine_cache.update(idx, self._bibdb.loc[idx])
+        if self._keys is not None:
+            self._keys.update(idx, self._bibdb.loc[idx])
+        if self._textindex is not None:
+            self._textindex.add(idx, self._bibdb.loc[idx])
+
+    def dedup(self, threshold=0.8, fuzzy=False, min_score=0.5, debug=False):
+        """ merge duplicated records (fuzzy: similar titles by MinHash) and return merge report """
+
+        if fuzzy:
+            # similar titles are merged only when other fields agree (min_score) and identifiers do not differ
+            pairs = bibdb.near_duplicates(self._bibdb, threshold=threshold, debug=debug)
+            p, report = bibdb.merge_pairs(self._bibdb, pairs, min_score=min_score, report=True, debug=debug)
+        else:
+            clusters = bibdb.find_duplicates(self._bibdb, threshold=threshold, debug=debug)
+            p, report = bibdb.merge_clusters(self._bibdb, clusters, debug=debug)
+
+        if len(report) == 0:
+            print('... no duplicated records')
+            return
+
+        print('... merged {} records into {} records'.format(sum([ len(x) for x in report['merged'] ]), len(report)))
+
+        # keep labels: report index stays valid and only merged records are saved
+        self._drop([ i for m in report['merged'] for i in m ])
+        self._bibdb = p
+        for idx in report['idx']:
+            self._touch(idx)
+
+        return report
 
     def update(self, idx=-1):
         """ save database """
 
         if idx > -1:
-            self._bibdb = filedb.update_filedb(self._bibdb, self._bibdb.at[idx, 'local-url'], debug=self._debug)
-            self._updated = True
+            self._bibdb = filedb.update_filedb(self._bibdb, self._bibdb.at[idx, 'local-url'], index=self.key_index(), debug=self._debug)
+            self._touch(idx)
 
         if self._updated:
             print('... save database to {}'.format(self._bibfilename))
-            self._bibdb.to_csv(self._bibfilename)
+        elif len(self._dirty) + len(self._deleted) > 0:
+            print('... save {} records, delete {} records in {}'.format(len(self._dirty), len(self._deleted), self._bibfilename))
+        else:
+            return
+        self._save()
+
+        full = self._updated
+        self._updated = False
+        self._dirty = set()
+        self._deleted = set()
+
+        if full and (self._textindex is not None):
+            self.text_index(update=True)
+        elif full:
+            # records are renumbered: drop old index files
+            self._drop_index()
+        else:
+            self._save_index()
 
     def reload(self, update=True):
         """ re-read bibdb """
 
-        self._bibdb = filedb.build_filedb(dirname=self._dirname, debug=debug)
+        if update and os.path.exists(self._fpfname):
+            return self.sync()
+
+        fp = filedb.file_fingerprints(sorted(glob.glob(self._dirname + '/*.pdf')))
+        p = filedb.build_filedb(dirname=self._dirname, workers=self._workers, debug=self._debug, flist=list(fp.index))
+        self._bibdb = bibdb.clean_db(p)
+        self._reindex()
         print('... save database to {}'.format(self._bibfilename))
-        self._bibdb.to_csv(self._bibfilename)
+        self._updated = True
+        self._save()
+        self._updated = False
+        self._dirty = set()
+        fp.to_csv(self._fpfname)
+        self.text_index(update=True)
+
+    def sync(self):
+        """ re-read only added or changed pdf files using saved fingerprints """
+
+        fp = None
+        if os.path.exists(self._fpfname):
+            fp = pd.read_csv(self._fpfname, index_col=0)
+
+        changed, deleted, fp = filedb.diff_filedb(self._bibdb, fp, dirname=self._dirname)
+        if len(changed) + len(deleted) == 0:
+            return
+
+        # records of other files keep their index
+        self._drop(deleted)
+        if len(changed) > 0:
+            p = filedb.build_filedb(dirname=self._dirname, workers=self._workers, debug=self._debug, flist=changed)
+            self.add_records(bibdb.clean_db(p))
+        else:
+            self.update()
+        fp.to_csv(self._fpfname)
 
     # recommender system
 
-    def build_recommender(self, update=False):
+    def build_recommender(self, update=False, max_memory=None, workers=None):
         """ using text contents build vectorized representation of papers """
 
-        pids = range(len(self._bibdb))
+        if workers is None:
+            workers = self._workers
 
         if os.path.exists(self._tfidfname) and os.path.exists(self._metafname) and (not update):
             print('... read from {}, {}'.format(self._tfidfname, self._metafname))
@@ -309,23 +648,21 @@ class PaperDB(object):
             meta = pickle.load(open(self._metafname, 'rb'))
             self._vocab = meta['vocab']
             self._idf = meta['idf']
+            self._vectorizer = meta.get('vectorizer')
+            self._paths = meta.get('paths')
+            self._nfit = meta.get('n_fit', self._X.shape[0])
+            # old metadata: rows follow database order
+            if (self._paths is None) and (self._X.shape[0] == len(self._bibdb)):
+                self._paths = list(self._bibdb['local-url'].values)
+            self._rowof = None
         else:
+            import tqdm
+            from sklearn.feature_extraction.text import TfidfVectorizer
+
             print('... read all texts')
-            corpus = []
-            for i in tqdm.tqdm(pids):
-                self.paper(i, exif=False)
-                txt = '{}\n{}'.format(self._currentpaper.abstract(), self._currentpaper.contents(split=False, update=False))
-                corpus.append(txt)
-
-            # clean up text
-            corpus = [ re.sub('\\n', ' ', str(x)) for x in corpus ]
-            corpus = [ re.sub("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}",'',str(x)) for x in corpus ]
-            corpus = [ re.sub("(http://.*?\s)|(http://.*)",'',str(x)) for x in corpus ]
-            corpus = [ x.replace("royalsocietypublishing", "") for x in corpus ]
-            corpus = [ x.replace("annualreviews", "") for x in corpus ]
-            corpus = [ x.replace("science reports", "") for x in corpus ]
-            corpus = [ x.replace("nature publishing group", "") for x in corpus ]
-            self.corpus = corpus
+            cache = corpus.TextCache(self._corpusfname)
+            fnames = self._bibdb['local-url'].values
+            docs = tqdm.tqdm(corpus.iter_corpus(fnames, cache=cache, debug=self._debug), total=len(fnames))
 
             # prepare vectorizer
             v = TfidfVectorizer(input='content',
@@ -335,97 +672,267 @@ class PaperDB(object):
                     ngram_range=(1, 3), max_features = 5000,
                     norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
                     max_df=1.0, min_df=1)
-            v.fit(corpus)
-            self._X = v.transform(corpus)
-
+            self._X = v.fit_transform(docs)
+            cache.prune(fnames)
+            cache.close()
+
+            # keep fitted vocabulary and idf for incremental updates
+            if hasattr(v, 'stop_words_'):
+                v.stop_words_ = None
+            self._vectorizer = v
             self._vocab = v.vocabulary_
             self._idf = v._tfidf.idf_
-
-            # write full matrix out
-            out = {}
-            out['X'] = self._X
-            print('... writing: {}'.format(self._tfidfname))
-            safe_pickle_dump(out, self._tfidfname)
-
-            # writing metatdata
-            out = {}
-            out['vocab'] = v.vocabulary_
-            out['idf'] = v._tfidf.idf_
-            out['pids'] = pids
-            print('... writing: {}'.format(self._metafname))
-            safe_pickle_dump(out, self._metafname)
-
-        if os.path.exists(self._simfname) and (not update):
-            print('... read from {}'.format(self._simfname))
-            self._sim_dict = pickle.load(open(self._simfname, 'rb'))
+            self._paths = list(fnames)
+            self._rowof = None
+            self._nfit = len(fnames)
+            self._save_tfidf()
+
+        if os.path.exists(self._simfname) and os.path.exists(self._simscorefname) and (not update):
+            print('... read from {}, {}'.format(self._simfname, self._simscorefname))
+            self._sim = recommender.SimilarityStore.load(self._simfname, self._simscorefname)
+        elif os.path.exists(self._oldsimfname) and (not update):
+            print('... convert {}'.format(self._oldsimfname))
+            self._sim = recommender.SimilarityStore.from_dict(pickle.load(open(self._oldsimfname, 'rb')))
+            self._sim.save(self._simfname, self._simscorefname)
         else:
             print("...precomputing nearest neighbor queries in batches...")
-            #X = X.todense() # originally it's a sparse matrix
-            X = self._X.todense().astype(np.float32)
-            self._sim_dict = {}
-            batch_size = 200
-            for i in range(0,len(pids),batch_size):
-                i1 = min(len(pids), i+batch_size)
-                xquery = X[i:i1] # BxD
-                ds = -np.asarray(np.dot(X, xquery.T)) #NxD * DxB => NxB
-                IX = np.argsort(ds, axis=0) # NxB
-                for j in range(i1-i):
-                    self._sim_dict[pids[i+j]] = [pids[q] for q in list(IX[:50,j])]
-
-                print('%d/%d...' % (i, len(pids)))
-
-            print('... writing: {}'.format(self._simfname))
-            safe_pickle_dump(self._sim_dict, self._simfname)
-
-    def recommend_similar(self, idx=0, n=5, items=[]):
-        """ recommend similar paper using feature matrix """
-
-        if len(self._sim_dict) == 0:
+            n = self._X.shape[0]
+            self._sim = recommender.SimilarityStore(n=n, k=50)
+            done = 0
+            for i, IX, score in recommender.nearest_neighbors(self._X, k=50, batch_size=200, max_memory=max_memory, workers=workers):
+                self._sim.put(i, IX, score)
+
+                done += len(IX)
+                print('%d/%d...' % (done, n))
+
+            print('... writing: {}, {}'.format(self._simfname, self._simscorefname))
+            self._sim.save(self._simfname, self._simscorefname)
+
+            # ann index rows follow the new feature matrix
+            if update and ((self._ann is not None) or os.path.exists(self._annfname)):
+                self.build_ann(update=True)
+
+    def build_ann(self, update=False, n_components=128):
+        """ approximate nearest neighbour index of feature matrix """
+
+        if (self._ann is not None) and (not update):
+            return self._ann
+
+        if os.path.exists(self._annfname) and (not update):
+            print('... read from {}'.format(self._annfname))
+            self._ann = pickle.load(open(self._annfname, 'rb'))
+        else:
+            if self._X is None:
+                self.build_recommender()
+
+            print('... build ann index: n_components {}'.format(n_components))
+            self._ann = recommender.ANNIndex(n_components=n_components).fit(self._X)
+            print('... writing: {}'.format(self._annfname))
+            safe_pickle_dump(self._ann, self._annfname)
+
+        return self._ann
+
+    def _save_tfidf(self):
+        """ write feature matrix and vectorizer metadata """
+
+        out = {}
+        out['X'] = self._X
+        print('... writing: {}'.format(self._tfidfname))
+        safe_pickle_dump(out, self._tfidfname)
+
+        out = {}
+        out['vocab'] = self._vocab
+        out['idf'] = self._idf
+        out['pids'] = range(len(self._paths))
+        out['paths'] = self._paths
+        out['n_fit'] = self._nfit
+        out['vectorizer'] = self._vectorizer
+        print('... writing: {}'.format(self._metafname))
+        safe_pickle_dump(out, self._metafname)
+
+    def update_recommender(self, drift=0.2, max_memory=None, workers=None):
+        """ add feature rows and neighbours of new papers (full refit when drift is large) """
+
+        if (self._X is None) or (self._sim is None):
             self.build_recommender()
 
-        rec_list = self._bibdb.iloc[self._sim_dict[idx][:n]]
-        return quickview(rec_list, items=items)
+        if (self._vectorizer is None) or (self._paths is None):
+            print('... no fitted vectorizer, full refit')
+            return self.build_recommender(update=True, max_memory=max_memory, workers=workers)
+
+        fnames = list(self._bibdb['local-url'].values)
+        known = set(self._paths)
+        new = [ f for f in dict.fromkeys(fnames) if f not in known ]
+        removed = len(known - set(fnames))
+
+        if len(new) == 0:
+            print('... no new papers')
+            return
+
+        # documents added or removed since last fit
+        change = (self._X.shape[0] - self._nfit + len(new) + removed) / max(self._nfit, 1)
+        if change > drift:
+            print('... drift {:.2f} > {:.2f}, full refit'.format(change, drift))
+            return self.build_recommender(update=True, max_memory=max_memory, workers=workers)
+
+        import scipy.sparse as sp
 
-    def build_topiclist(self, n_com=20, max_iter=10, n_keys=8, update=False):
-        """ make feature matrix using LDA """
+        print('... add {} papers'.format(len(new)))
+        cache = corpus.TextCache(self._corpusfname)
+        Xn = self._vectorizer.transform(corpus.iter_corpus(new, cache=cache, debug=self._debug))
+        cache.close()
 
-        if os.path.exists(self._ldafname) and (not update):
+        n0 = self._X.shape[0]
+        self._X = sp.vstack([self._X, Xn]).tocsr()
+        self._paths = self._paths + new
+        self._rowof = None
+        self._save_tfidf()
+
+        self._sim = recommender.add_rows(self._sim, self._X, n0, k=50, debug=self._debug)
+        print('... writing: {}, {}'.format(self._simfname, self._simscorefname))
+        self._sim.save(self._simfname, self._simscorefname)
+
+        if (self._ann is not None) or os.path.exists(self._annfname):
+            self.build_ann().add(Xn)
+            print('... writing: {}'.format(self._annfname))
+            safe_pickle_dump(self._ann, self._annfname)
+
+    def _matrix_row(self, idx):
+        """ feature matrix row of paper idx (-1: not in matrix) """
+
+        if self._rowof is None:
+            self._rowof = { p: i for i, p in enumerate(self._paths) }
+        return self._rowof.get(self._bibdb.at[idx, 'local-url'], -1)
+
+    def _paper_index(self, rows):
+        """ paper index of feature matrix rows (papers removed from db are skipped) """
+
+        keys = self.key_index()
+        out = []
+        for r in rows:
+            out.extend(keys.get('local-url', self._paths[r])[:1])
+        return out
+
+    def recommend_similar(self, idx=0, n=5, items=[], ann=False):
+        """ recommend similar paper using feature matrix (ann: any n from ann index) """
+
+        if self._sim is None:
+            self.build_recommender()
+
+        row = self._matrix_row(idx)
+        if row < 0:
+            print('... {} is not in feature matrix, run update_recommender()'.format(idx))
+            return
+
+        if ann or (n > 50):
+            rows, _ = self.build_ann().query(row, n=n)
+        else:
+            rows, _ = self._sim.row(row, n=n)
+
+        return quickview(self._bibdb.loc[self._paper_index(rows)], items=items)
+
+    def build_topiclist(self, n_com=20, max_iter=10, n_keys=8, update=False, batch_size=128):
+        """ make feature matrix using online LDA (update: refit, warm start from saved model) """
+
+        out = {}
+        if os.path.exists(self._ldafname):
             out = pickle.load(open(self._ldafname, 'rb'))
-            self._lda = out['lda']
-            self._topics = out['topics']
+            if not update:
+                self._lda = out['lda']
+                self._topics = out['topics']
+                self._ldamodel = out.get('model')
+                self._ldapaths = out.get('paths', [])
+                return
+
+        if self._sim is None:
+            self.build_recommender()
+
+        X = self._X.astype(np.float32)
+        lda = out.get('model')
+
+        # warm start only when the vocabulary is unchanged
+        if (lda is not None) and (lda.n_components == n_com) and (out.get('vocab') == self._vocab):
+            print("... warm start from {}: n_com {}, max_iter {}".format(self._ldafname, n_com, max_iter))
+            lda.total_samples = X.shape[0]
+            for it in range(max_iter):
+                for i in range(0, X.shape[0], batch_size):
+                    lda.partial_fit(X[i:i + batch_size])
         else:
-            if len(self._sim_dict) == 0:
-                self.build_recommender()
+            from sklearn.decomposition import LatentDirichletAllocation
 
-            X = self._X.todense().astype(np.float32)
             lda = LatentDirichletAllocation(n_components=n_com,
-                    learning_method='batch',
+                    learning_method='online', batch_size=batch_size,
+                    total_samples=X.shape[0],
                     max_iter=max_iter, verbose=1,
                     n_jobs=-1, random_state=0)
 
             print("... computing decomposition matrix: n_com {}, max_iter {}".format(n_com, max_iter))
-            paper_topics = lda.fit_transform(X)
-            feature_names = sorted(list(self._vocab.keys()))
-
-            for topic_idx, topic in enumerate(lda.components_):
-                msg = 'Topic [{}]: '.format(topic_idx)
-                msg += ', '.join([feature_names[i] for i in topic.argsort()[:-n_keys-1:-1]])
-                print(msg)
-
-            # writing lda result
-            out = {}
-            out['lda'] = paper_topics
-            out['topics'] = lda.components_
-            print('... writing: {}'.format(self._ldafname))
-            safe_pickle_dump(out, self._ldafname)
-            self._lda = paper_topics
-            self._topics = lda.components_
+            lda.fit(X)
+
+        paper_topics = lda.transform(X)
+        feature_names = sorted(list(self._vocab.keys()))
+
+        for topic_idx, topic in enumerate(lda.components_):
+            msg = 'Topic [{}]: '.format(topic_idx)
+            msg += ', '.join([feature_names[i] for i in topic.argsort()[:-n_keys-1:-1]])
+            print(msg)
+
+        self._ldamodel = lda
+        self._lda = paper_topics
+        self._topics = lda.components_
+        self._ldapaths = list(self._paths)
+        self._save_topics()
+
+    def _save_topics(self):
+        """ write lda model and topics of papers """
+
+        out = {}
+        out['lda'] = self._lda
+        out['topics'] = self._topics
+        out['model'] = self._ldamodel
+        out['vocab'] = self._vocab
+        out['paths'] = self._ldapaths
+        print('... writing: {}'.format(self._ldafname))
+        safe_pickle_dump(out, self._ldafname)
+
+    def update_topics(self, batch_size=128):
+        """ update online LDA with feature rows of new papers """
+
+        if self._ldamodel is None:
+            self.build_topiclist()
+        if self._sim is None:
+            self.build_recommender()
+
+        n0 = len(self._lda)
+        lda = self._ldamodel
+
+        # model of another vocabulary or rows: refit
+        if (lda is None) or (self._ldapaths != self._paths[:n0]):
+            print('... feature matrix changed, refit topics')
+            return self.build_topiclist(n_com=len(self._topics) or 20, update=True, batch_size=batch_size)
+
+        if n0 >= self._X.shape[0]:
+            print('... no new papers')
+            return
+
+        Xn = self._X[n0:].astype(np.float32)
+        print('... add {} papers to topics'.format(Xn.shape[0]))
+        lda.total_samples = self._X.shape[0]
+        for i in range(0, Xn.shape[0], batch_size):
+            lda.partial_fit(Xn[i:i + batch_size])
+
+        self._lda = np.vstack([self._lda, lda.transform(Xn)])
+        self._topics = lda.components_
+        self._ldapaths = list(self._paths)
+        self._save_topics()
 
     def recommend_topic(self, tid=0, n=5, n_com=20, n_keys=8, items=[]):
         """ recommend papers using decomposition """
 
+        if self._sim is None:
+            self.build_recommender()
         if len(self._lda) == 0:
-            self.build_topiclist(n_com=ncom, n_keys=n_keys)
+            self.build_topiclist(n_com=n_com, n_keys=n_keys)
 
         topic = self._topics[tid]
         feature_names = sorted(list(self._vocab.keys()))
@@ -433,7 +940,7 @@ class PaperDB(object):
         print('Topic {}: {}'.format(tid, msg))
 
         idxlist = np.argsort(self._lda[:, tid])[::-1]
-        lda_list = self._bibdb.iloc[idxlist[:n]]
+        lda_list = self._bibdb.loc[self._paper_index(idxlist[:n])]
         return quickview(lda_list, items=items)
 
     def word_list(self):
@@ -448,34 +955,14 @@ class PaperDB(object):
 
 
 def search(pd_db, year=0, author='', journal='', author1='', title='', doi='', byindex=False):
-    """ search panda database by keywords """
-
-    if ("author1" not in pd_db.columns) and ("author" in pd_db.columns):
-        pd_db["author1"] = [ x.split(' and ')[0] for x in pd_db['author'].values ]
+    """ search panda database by keywords (year: int or (from, to)) """
 
-    if year != 0:
-        pd_db.loc[:, 'year'] = pd_db.loc[:, 'year'].astype(int)
-        db = pd_db.loc[pd_db['year'] == year]
-    else:
-        db = pd_db
-
-    def _search_item(db, column, value):
-        if (value != '') and (column in db.columns):
-            db[column].fillna('', inplace=True)
-            return db.loc[db[column].str.contains(value)]
-        else:
-            return db
-
-    db = _search_item(db, "author", author)
-    db = _search_item(db, "author1", author1)
-    db = _search_item(db, "journal", journal)
-    db = _search_item(db, "title", title)
-    db = _search_item(db, "doi", doi)
+    idx = query.SearchEngine(pd_db).search(year=year, author=author, journal=journal, author1=author1, title=title, doi=doi)
 
     if byindex:
-        return db.index
+        return pd.Index(idx)
     else:
-        return db
+        return pd_db.loc[idx]
 
 
 def quickview(pd_db, items=[], add=True):
@@ -492,3 +979,161 @@ def quickview(pd_db, items=[], add=True):
     return pd_db[views]
 
 
+def _output(res, fmt='tsv'):
+    """ print records (pandas db) or summary (dict) as tsv or json lines """
+
+    import json
+
+    if res is None:
+        return
+    # records carry row index as idx, reports (dedup) have their own idx column
+    if isinstance(res, dict):
+        res = pd.DataFrame([res])
+        index = False
+    else:
+        index = 'idx' not in res.columns
+
+    if fmt == 'json':
+        if index:
+            res = res.reset_index().rename(columns={'index': 'idx'})
+        for row in res.to_dict('records'):
+            print(json.dumps(row, ensure_ascii=False, default=str))
+    else:
+        print(res.to_csv(sep='\t', index=index, index_label='idx'), end='')
+
+
+def main(argv=None):
+    """ command line interface for batch jobs """
+
+    import sys
+    import argparse
+    import contextlib
+
+    parser = argparse.ArgumentParser(prog='py_paperdb', description='paper database batch commands')
+    parser.add_argument('--dir', default='.', help='paper directory')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--engine', default=None, choices=['arrow', 'csv', 'sqlite'], help='database file format')
+    parser.add_argument('--format', default='tsv', choices=['tsv', 'json'], help='output format')
+    parser.add_argument('--debug', action='store_true')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_sync = sub.add_parser('sync', help='re-read added or changed pdf files')
+    p_sync.add_argument('--full', action='store_true', help='rebuild database from all pdf files')
+
+    p_search = sub.add_parser('search', help='search papers')
+    p_search.add_argument('query', nargs='*', help='full text query (words, OR, "phrase", prefix*)')
+    p_search.add_argument('--year', default='0', help='year or from:to')
+    for c in ['author', 'author1', 'journal', 'title', 'doi']:
+        p_search.add_argument('--' + c, default='')
+    p_search.add_argument('--items', nargs='*', default=[], help='additional columns')
+
+    p_similar = sub.add_parser('similar', help='similar papers by text contents')
+    p_similar.add_argument('idx', nargs='?', type=int, default=None, help='paper index')
+    p_similar.add_argument('--doi', default='')
+    p_similar.add_argument('-n', type=int, default=5)
+    p_similar.add_argument('--ann', action='store_true', help='use approximate index')
+
+    p_export = sub.add_parser('export-bib', help='write bibtex file')
+    p_export.add_argument('-o', '--output', default='.paperdb.bib')
+
+    p_dedup = sub.add_parser('dedup', help='merge duplicated records')
+    p_dedup.add_argument('--threshold', type=float, default=0.8)
+    p_dedup.add_argument('--fuzzy', action='store_true', help='similar titles by MinHash')
+    p_dedup.add_argument('--min-score', type=float, default=0.5, help='field score of fuzzy pairs to merge')
+    p_dedup.add_argument('--dry-run', action='store_true', help='report without saving')
+
+    p_index = sub.add_parser('build-index', help='build search and recommender indexes')
+    p_index.add_argument('--recommender', action='store_true', help='add new papers to tf-idf and neighbour table')
+    p_index.add_argument('--ann', action='store_true', help='approximate neighbour index')
+    p_index.add_argument('--topics', action='store_true', help='update topic model')
+    p_index.add_argument('--full', action='store_true', help='refit instead of incremental update')
+
+    p_watch = sub.add_parser('watch', help='move new pdf files from inbox into database')
+    p_watch.add_argument('inbox', help='inbox directory')
+    p_watch.add_argument('--settle', type=float, default=2.0, help='seconds without change before reading a file')
+    p_watch.add_argument('--interval', type=float, default=1.0, help='polling interval in seconds')
+
+    p_serve = sub.add_parser('serve', help='keep database in memory and answer queries on unix socket')
+    p_serve.add_argument('--socket', default='./.paperdb.sock')
+
+    args = parser.parse_args(argv)
+    if args.command == 'watch':
+        args.inbox = os.path.abspath(args.inbox)
+    os.chdir(args.dir)
+
+    if args.command == 'watch':
+        import watcher
+        watcher.Watcher(PaperDB(cache=True, workers=args.workers, engine=args.engine, debug=args.debug),
+                args.inbox, settle=args.settle, interval=args.interval, debug=args.debug).run()
+        return 0
+
+    if args.command == 'serve':
+        import server
+        server.serve(PaperDB(cache=True, workers=args.workers, engine=args.engine, debug=args.debug), path=args.socket, debug=args.debug)
+        return 0
+
+    # progress messages go to stderr, results to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        p = PaperDB(cache=True, workers=args.workers, engine=args.engine, debug=args.debug)
+        res = None
+
+        if args.command == 'sync':
+            if args.full:
+                p.reload(update=False)
+            else:
+                p.sync()
+            res = {'records': len(p._bibdb)}
+
+        elif args.command == 'search':
+            year = args.year
+            year = tuple([ int(x) for x in year.split(':') ]) if ':' in year else int(year)
+            idx = p.search_engine().search(year=year, author=args.author, journal=args.journal,
+                    author1=args.author1, title=args.title, doi=args.doi)
+            if len(args.query) > 0:
+                hits = set(p.text_index().query(' '.join(args.query)))
+                idx = [ i for i in idx if i in hits ]
+            res = quickview(p._bibdb.loc[idx], items=args.items)
+
+        elif args.command == 'similar':
+            idx = args.idx
+            if args.doi != '':
+                found = p.key_index().get('doi', args.doi)
+                idx = found[0] if len(found) > 0 else None
+            if idx is None:
+                print('... no paper')
+                return 1
+            res = p.recommend_similar(idx, n=args.n, ann=args.ann)
+
+        elif args.command == 'export-bib':
+            p.export_bib(bibfilename=args.output)
+            res = {'records': len(p._bibdb), 'file': args.output}
+
+        elif args.command == 'dedup':
+            report = p.dedup(threshold=args.threshold, fuzzy=args.fuzzy, min_score=args.min_score, debug=args.debug)
+            if (report is not None) and (not args.dry_run):
+                p.update()
+            res = report
+
+        elif args.command == 'build-index':
+            p.text_index(update=True)
+            if args.recommender:
+                if args.full:
+                    p.build_recommender(update=True)
+                else:
+                    p.update_recommender()
+            if args.ann:
+                p.build_ann(update=args.full)
+            if args.topics:
+                if args.full:
+                    p.build_topiclist(update=True)
+                else:
+                    p.update_topics()
+            res = {'records': len(p._bibdb), 'index': len(p.text_index())}
+
+    _output(res, fmt=args.format)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
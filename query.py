@@ -0,0 +1,194 @@
+"""
+query.py
+
+precomputed search engine for paper database
+"""
+
+import numpy as np
+import pandas as pd
+
+text_columns = ['author', 'author1', 'journal', 'title', 'doi']
+
+
+def _author1(author):
+    """ first author from bibtex author string """
+
+    return str(author).split(' and ')[0]
+
+
+def _year(year):
+    """ year as int (0 for unknown) """
+
+    try:
+        return int(float(year))
+    except (TypeError, ValueError):
+        return 0
+
+
+class SearchEngine(object):
+    """ lowercased text columns, int years and doi map for one boolean mask search """
+
+    def __init__(self, pd_db):
+        """ precompute search columns of pandas db """
+
+        self._index = list(pd_db.index)
+        self._pos = { idx: i for i, idx in enumerate(self._index) }
+        self._text = {}
+
+        for c in text_columns:
+            if c in pd_db.columns:
+                values = pd_db[c].values
+            elif (c == 'author1') and ('author' in pd_db.columns):
+                values = [ _author1(x) for x in pd_db['author'].values ]
+            else:
+                continue
+            self._text[c] = np.array([ '' if pd.isna(x) else str(x).lower() for x in values ], dtype=object)
+
+        if 'year' in pd_db.columns:
+            self._year = pd.to_numeric(pd_db['year'], errors='coerce').fillna(0).astype(np.int64).values.copy()
+        else:
+            self._year = np.zeros(len(self._index), dtype=np.int64)
+
+        self._doi = {}
+        if 'doi' in self._text:
+            for i, d in enumerate(self._text['doi']):
+                if d != '':
+                    self._doi.setdefault(d, []).append(i)
+
+    def __len__(self):
+        return len(self._index)
+
+    def update(self, idx, row):
+        """ update or append one record """
+
+        if idx not in self._pos:
+            self._pos[idx] = len(self._index)
+            self._index.append(idx)
+            for c in self._text:
+                self._text[c] = np.append(self._text[c], '')
+            self._year = np.append(self._year, 0)
+        i = self._pos[idx]
+
+        for c in self._text:
+            if c in row:
+                v = row[c]
+            elif c == 'author1':
+                v = _author1(row.get('author', ''))
+            else:
+                v = ''
+            v = '' if (not isinstance(v, str)) and pd.isna(v) else str(v).lower()
+
+            if c == 'doi':
+                old = self._text[c][i]
+                if old in self._doi:
+                    self._doi[old] = [ j for j in self._doi[old] if j != i ]
+                    if len(self._doi[old]) == 0:
+                        del self._doi[old]
+                if v != '':
+                    self._doi.setdefault(v, []).append(i)
+
+            self._text[c][i] = v
+
+        self._year[i] = _year(row.get('year', 0))
+
+    def mask(self, year=0, author='', journal='', author1='', title='', doi=''):
+        """ boolean mask of all conditions (year: int or (from, to)) """
+
+        m = np.ones(len(self._index), dtype=bool)
+
+        if isinstance(year, (tuple, list)):
+            m &= (self._year >= int(year[0])) & (self._year <= int(year[1]))
+        elif year != 0:
+            m &= (self._year == int(year))
+
+        if (doi != '') and ('doi' in self._text):
+            hits = self._doi.get(doi.lower())
+            if hits is not None:
+                dm = np.zeros(len(self._index), dtype=bool)
+                dm[hits] = True
+                m &= dm
+                doi = ''
+
+        for c, v in [('author', author), ('author1', author1), ('journal', journal), ('title', title), ('doi', doi)]:
+            if (v == '') or (c not in self._text):
+                continue
+            # only test rows still selected
+            sel = np.flatnonzero(m)
+            v = v.lower()
+            m[sel] = [ v in x for x in self._text[c][sel] ]
+
+        return m
+
+    def search(self, **kwargs):
+        """ index of records matching all conditions """
+
+        return [ self._index[i] for i in np.flatnonzero(self.mask(**kwargs)) ]
+
+
+key_columns = ['doi', 'pmid', 'pmcid', 'local-url']
+
+
+def _key(column, value):
+    """ normalized identifier ('' for missing) """
+
+    if (not isinstance(value, str)) and pd.isna(value):
+        return ''
+    value = str(value).strip()
+    if value == 'nan':
+        return ''
+    if column == 'doi':
+        value = value.lower()
+    return value
+
+
+class KeyIndex(object):
+    """ dict indexes of identifiers (doi, pmid, pmcid, local-url) to record index """
+
+    def __init__(self, pd_db=None, columns=None):
+        """ build indexes from pandas db """
+
+        if columns is None:
+            columns = key_columns
+
+        self._columns = columns
+        self._maps = { c: {} for c in columns }
+        self._keys = {}             # idx -> identifiers of record
+
+        if pd_db is not None:
+            cols = [ c for c in columns if c in pd_db.columns ]
+            for idx, row in zip(pd_db.index, pd_db[cols].to_dict('records')):
+                self.update(idx, row)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def remove(self, idx):
+        """ remove one record from indexes """
+
+        keys = self._keys.pop(idx, None)
+        if keys is None:
+            return
+
+        for c, k in keys.items():
+            hits = self._maps[c][k]
+            hits.remove(idx)
+            if len(hits) == 0:
+                del self._maps[c][k]
+
+    def update(self, idx, row):
+        """ add or replace identifiers of one record """
+
+        self.remove(idx)
+
+        keys = {}
+        for c in self._columns:
+            k = _key(c, row.get(c, ''))
+            if k != '':
+                keys[c] = k
+                self._maps[c].setdefault(k, []).append(idx)
+        self._keys[idx] = keys
+
+    def get(self, column, value):
+        """ record indexes with identifier value """
+
+        return list(self._maps[column].get(_key(column, value), []))
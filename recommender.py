@@ -0,0 +1,270 @@
+"""
+recommender.py
+
+nearest neighbour tables of tf-idf feature matrix
+"""
+
+import concurrent.futures
+import numpy as np
+
+from utils import open_atomic
+
+# feature matrix shared with worker processes
+_shared = {}
+
+
+def _batch_size(n, batch_size=200, max_memory=None):
+    """ limit batch size so that one batch uses less than max_memory MB """
+
+    if max_memory is None:
+        return batch_size
+
+    # float32 scores, their negative copy and int64 partition index per pair
+    return max(1, min(batch_size, int(max_memory * 2**20 // (16 * max(n, 1)))))
+
+
+def topk_rows(X, i0, i1, k=50):
+    """ top-k neighbours (index, score) of rows i0:i1 by sparse dot product """
+
+    S = (X[i0:i1] @ X.T).toarray()     # BxN
+    k = min(k, S.shape[1])
+
+    part = np.argpartition(-S, k - 1, axis=1)[:, :k]
+    part.sort(axis=1)
+    score = np.take_along_axis(S, part, axis=1)
+
+    # descending score, ascending index for ties
+    order = np.argsort(-score, axis=1, kind='stable')
+    IX = np.take_along_axis(part, order, axis=1).astype(np.int32)
+    score = np.take_along_axis(score, order, axis=1).astype(np.float32)
+
+    return IX, score
+
+
+def _init_worker(X, k):
+    """ keep matrix in worker and use one BLAS thread per process """
+
+    _shared['X'] = X
+    _shared['k'] = k
+
+    try:
+        from threadpoolctl import threadpool_limits
+        _shared['limits'] = threadpool_limits(limits=1)
+    except ImportError:
+        pass
+
+
+def _worker_rows(i0, i1):
+    """ top-k neighbours of rows i0:i1 in worker process """
+
+    IX, score = topk_rows(_shared['X'], i0, i1, k=_shared['k'])
+    return i0, IX, score
+
+
+def nearest_neighbors(X, k=50, batch_size=200, max_memory=None, workers=1, debug=False):
+    """ yield (first row, index, score) of top-k neighbours for batches of rows (in finished order) """
+
+    X = X.tocsr().astype(np.float32)
+    n = X.shape[0]
+    if max_memory is not None:
+        max_memory = max_memory / max(workers, 1)
+    batch_size = _batch_size(n, batch_size=batch_size, max_memory=max_memory)
+    batches = [ (i, min(n, i + batch_size)) for i in range(0, n, batch_size) ]
+
+    if workers <= 1:
+        for i, i1 in batches:
+            IX, score = topk_rows(X, i, i1, k=k)
+            if debug: print('%d/%d...' % (i, n))
+            yield i, IX, score
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(X, k)) as ex:
+        futures = [ ex.submit(_worker_rows, i, i1) for i, i1 in batches ]
+        for f in concurrent.futures.as_completed(futures):
+            i, IX, score = f.result()
+            if debug: print('%d/%d...' % (i, n))
+            yield i, IX, score
+
+
+def _merge_topk(IX, score, k):
+    """ keep top-k of candidate lists (descending score, ascending index for ties) """
+
+    score = np.where(IX >= 0, score, -np.inf)
+    order = np.lexsort((IX, -score))[:, :k]
+    IX = np.take_along_axis(IX, order, axis=1)
+    score = np.take_along_axis(score, order, axis=1)
+
+    return IX, np.where(IX >= 0, score, 0).astype(np.float32)
+
+
+def add_rows(store, X, n0, k=50, batch_size=200, debug=False):
+    """ extend neighbour table to new rows n0: of X and insert them in old rows they enter """
+
+    X = X.tocsr().astype(np.float32)
+    n = X.shape[0]
+    k = store.index.shape[1] if len(store) > 0 else k
+
+    out = SimilarityStore(n=n, k=k)
+    out.index[:n0] = store.index[:n0]
+    out.score[:n0] = store.score[:n0]
+
+    # k-th score of old rows (-inf when the list is not full)
+    kth = np.where(out.index[:n0, -1] >= 0, out.score[:n0, -1], -np.inf)
+
+    for i in range(n0, n, batch_size):
+        i1 = min(n, i + batch_size)
+        out.put(i, *topk_rows(X, i, i1, k=k))
+
+        # old rows where one of the new rows beats the k-th neighbour
+        S = (X[:n0] @ X[i:i1].T).toarray()
+        hit = np.flatnonzero((S > kth[:, None]).any(axis=1))
+        if len(hit) > 0:
+            cand = np.broadcast_to(np.arange(i, i1, dtype=np.int32), (len(hit), i1 - i))
+            IX, score = _merge_topk(np.hstack([out.index[hit], cand]), np.hstack([out.score[hit], S[hit]]), k)
+            out.index[hit] = IX
+            out.score[hit] = score
+            kth[hit] = np.where(IX[:, -1] >= 0, score[:, -1], -np.inf)
+
+        if debug: print('%d/%d... %d old rows changed' % (i1, n, len(hit)))
+
+    return out
+
+
+class ANNIndex(object):
+    """ random projection LSH over SVD-reduced feature vectors """
+
+    def __init__(self, n_components=128, n_tables=8, n_bits=12, seed=0):
+        """ empty index """
+
+        self._n_components = n_components
+        self._n_tables = n_tables
+        self._n_bits = n_bits
+        self._seed = seed
+        self._svd = None
+        self._E = np.zeros((0, 0), dtype=np.float32)
+        self._planes = None
+        self._buckets = []
+
+    def __len__(self):
+        return self._E.shape[0]
+
+    def _embed(self, X):
+        """ reduced and l2 normalized vectors """
+
+        E = self._svd.transform(X).astype(np.float32)
+        norm = np.linalg.norm(E, axis=1, keepdims=True)
+        norm[norm == 0] = 1.0
+        return E / norm
+
+    def _codes(self, E):
+        """ bucket code of vectors in each table (TxN) """
+
+        bits = (np.einsum('tbd,nd->tnb', self._planes, E) > 0).astype(np.int64)
+        return (bits << np.arange(self._n_bits)).sum(axis=2)
+
+    def fit(self, X):
+        """ reduce feature matrix by SVD and hash all rows """
+
+        from sklearn.decomposition import TruncatedSVD
+
+        d = max(1, min(self._n_components, X.shape[1] - 1, X.shape[0] - 1))
+        self._svd = TruncatedSVD(n_components=d, random_state=self._seed).fit(X)
+
+        rng = np.random.RandomState(self._seed)
+        self._planes = rng.randn(self._n_tables, self._n_bits, d).astype(np.float32)
+        self._E = np.zeros((0, d), dtype=np.float32)
+        self._buckets = [ {} for _ in range(self._n_tables) ]
+
+        return self.add(X)
+
+    def add(self, X):
+        """ add new rows of feature matrix without refitting """
+
+        E = self._embed(X)
+        n0 = self._E.shape[0]
+        self._E = np.vstack([self._E, E])
+
+        for t, codes in enumerate(self._codes(E)):
+            for i, c in enumerate(codes):
+                self._buckets[t].setdefault(c, []).append(n0 + i)
+
+        return self
+
+    def query(self, idx, n=5):
+        """ n most similar rows (index, score) of row idx """
+
+        q = self._E[idx]
+        n = min(n, len(self))
+
+        cand = set()
+        for t, c in enumerate(self._codes(q[None, :])[:, 0]):
+            cand.update(self._buckets[t].get(c, []))
+
+        # not enough candidates in buckets: compare with all rows
+        if len(cand) < n:
+            cand = np.arange(len(self))
+        else:
+            cand = np.fromiter(cand, dtype=np.int64)
+
+        score = self._E[cand] @ q
+        k = min(n, len(cand))
+        top = np.argpartition(-score, k - 1)[:k]
+        top = top[np.argsort(-score[top], kind='stable')]
+
+        return cand[top], score[top]
+
+
+class SimilarityStore(object):
+    """ NxK neighbour index (int32) and score (float32) arrays kept as .npy files """
+
+    def __init__(self, n=0, k=50):
+        """ empty table (-1: no neighbour) """
+
+        self.index = np.full((n, k), -1, dtype=np.int32)
+        self.score = np.zeros((n, k), dtype=np.float32)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @classmethod
+    def from_dict(cls, sim_dict, k=50):
+        """ convert old dict of neighbour lists (scores are unknown) """
+
+        store = cls(n=max(sim_dict.keys()) + 1 if len(sim_dict) > 0 else 0, k=k)
+        for i, rows in sim_dict.items():
+            rows = list(rows)[:k]
+            store.index[i, :len(rows)] = rows
+        return store
+
+    @classmethod
+    def load(cls, index_fname, score_fname, mmap=True):
+        """ read arrays, memory-mapped by default """
+
+        store = cls()
+        mode = 'r' if mmap else None
+        store.index = np.load(index_fname, mmap_mode=mode)
+        store.score = np.load(score_fname, mmap_mode=mode)
+        return store
+
+    def save(self, index_fname, score_fname):
+        """ write arrays atomically """
+
+        with open_atomic(index_fname, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.index))
+        with open_atomic(score_fname, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.score))
+
+    def put(self, i0, IX, score):
+        """ write neighbours of rows i0, i0+1, ... """
+
+        k = min(IX.shape[1], self.index.shape[1])
+        self.index[i0:i0 + len(IX), :k] = IX[:, :k]
+        self.score[i0:i0 + len(IX), :k] = score[:, :k]
+
+    def row(self, idx, n=None):
+        """ neighbour index and score of one row (reads only that row) """
+
+        rows = np.asarray(self.index[idx, :n])
+        score = np.asarray(self.score[idx, :n])
+        valid = rows >= 0
+        return rows[valid], score[valid]
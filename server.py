@@ -0,0 +1,276 @@
+"""
+server.py
+
+query server keeping one paper database in memory (json lines over unix socket)
+"""
+
+import os
+import sys
+import json
+import signal
+import socket
+import asyncio
+
+default_socket = './.paperdb.sock'
+
+# commands changing the database, applied one by one by the writer task
+write_commands = ['sync', 'update', 'build-index']
+
+
+def _records(pd_db):
+    """ pandas db as list of dicts with index """
+
+    if pd_db is None:
+        return []
+    return pd_db.reset_index().rename(columns={'index': 'idx'}).to_dict('records')
+
+
+class PaperServer(object):
+    """ serve search, similar and topic queries from one resident PaperDB """
+
+    def __init__(self, db, path=default_socket, debug=False):
+        """ server for PaperDB object db """
+
+        self._db = db
+        self._path = path
+        self._debug = debug
+        self._queue = None
+        self._idle = None
+        self._reads = 0
+        self._no_reads = None
+
+    def preload(self):
+        """ load indexes and models that exist on disk """
+
+        p = self._db
+        p.search_engine()
+        p.key_index()
+        p.text_index()
+        if os.path.exists(p._tfidfname) and os.path.exists(p._metafname):
+            p.build_recommender()
+        if os.path.exists(p._annfname):
+            p.build_ann()
+        if os.path.exists(p._ldafname):
+            p.build_topiclist()
+
+    def _find(self, args):
+        """ paper index from idx or doi argument """
+
+        if args.get('doi', '') != '':
+            found = self._db.key_index().get('doi', args['doi'])
+            if len(found) == 0:
+                raise KeyError('no paper with doi {}'.format(args['doi']))
+            return found[0]
+        return int(args['idx'])
+
+    def read(self, cmd, args):
+        """ run read-only command """
+
+        p = self._db
+
+        if cmd == 'ping':
+            return {'records': len(p._bibdb)}
+
+        if cmd == 'search':
+            year = args.get('year', 0)
+            idx = p.search_engine().search(year=tuple(year) if isinstance(year, list) else year,
+                    author=args.get('author', ''), journal=args.get('journal', ''), author1=args.get('author1', ''),
+                    title=args.get('title', ''), doi=args.get('doi', ''))
+            if args.get('query', '') != '':
+                hits = set(p.text_index().query(args['query']))
+                idx = [ i for i in idx if i in hits ]
+            return _records(p._bibdb.loc[idx, [ c for c in ['year', 'author1', 'title', 'journal', 'doi', 'local-url'] if c in p._bibdb.columns ]])
+
+        # models are built only by build-index (writer), not by reads
+        if cmd == 'similar':
+            n = int(args.get('n', 5))
+            ann = bool(args.get('ann', False))
+            if p._sim is None:
+                raise RuntimeError('recommender is not loaded, send build-index with recommender')
+            if (ann or (n > 50)) and (p._ann is None):
+                raise RuntimeError('ann index is not loaded, send build-index with ann')
+            return _records(p.recommend_similar(self._find(args), n=n, ann=ann))
+
+        if cmd == 'topic':
+            if (p._sim is None) or (len(p._lda) == 0):
+                raise RuntimeError('topics are not loaded, send build-index with topics')
+            return _records(p.recommend_topic(int(args.get('tid', 0)), n=int(args.get('n', 5))))
+
+        if cmd == 'item':
+            return _records(p._bibdb.loc[[self._find(args)]])
+
+        raise ValueError('unknown command: {}'.format(cmd))
+
+    def write(self, cmd, args):
+        """ run command changing database (in writer thread) """
+
+        p = self._db
+
+        if cmd == 'sync':
+            p.sync()
+            if p._X is not None:
+                p.update_recommender()
+        elif cmd == 'update':
+            p.update(self._find(args))
+        elif cmd == 'build-index':
+            p.text_index(update=True)
+            if args.get('recommender', False):
+                p.update_recommender()
+            if args.get('ann', False):
+                p.build_ann(update=True)
+            if args.get('topics', False):
+                p.update_topics()
+
+        # indexes dropped by the write are rebuilt here, not in reads
+        p.search_engine()
+        p.key_index()
+        p.text_index()
+
+        return {'records': len(p._bibdb)}
+
+    async def _writer(self):
+        """ apply queued updates one at a time, after running reads and blocking new reads """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            cmd, args, fut = await self._queue.get()
+            self._idle.clear()
+            await self._no_reads.wait()
+            try:
+                fut.set_result(await loop.run_in_executor(None, self.write, cmd, args))
+            except Exception as e:
+                fut.set_exception(e)
+            finally:
+                self._idle.set()
+                self._queue.task_done()
+
+    async def _read(self, cmd, args):
+        """ run read in thread pool so that reads of clients run concurrently """
+
+        # writer may start again before a waiting read resumes
+        while not self._idle.is_set():
+            await self._idle.wait()
+        self._reads += 1
+        self._no_reads.clear()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self.read, cmd, args)
+        finally:
+            self._reads -= 1
+            if self._reads == 0:
+                self._no_reads.set()
+
+    async def _handle(self, reader, writer):
+        """ answer json requests of one client connection """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            res = {}
+            try:
+                req = json.loads(line)
+                res['id'] = req.get('id')
+                cmd = req.get('cmd', '')
+                args = req.get('args', {})
+
+                if cmd in write_commands:
+                    fut = loop.create_future()
+                    await self._queue.put((cmd, args, fut))
+                    res['result'] = await fut
+                else:
+                    res['result'] = await self._read(cmd, args)
+                res['ok'] = True
+            except Exception as e:
+                res['ok'] = False
+                res['error'] = '{}: {}'.format(type(e).__name__, e)
+
+            writer.write((json.dumps(res, ensure_ascii=False, default=str) + '\n').encode('utf-8'))
+            await writer.drain()
+
+        writer.close()
+
+    async def serve(self):
+        """ listen on unix socket until cancelled """
+
+        self._queue = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._no_reads = asyncio.Event()
+        self._no_reads.set()
+
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+        server = await asyncio.start_unix_server(self._handle, path=self._path)
+        writer = asyncio.ensure_future(self._writer())
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        print('... serving {} records on {}'.format(len(self._db._bibdb), self._path))
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer.cancel()
+            if os.path.exists(self._path):
+                os.remove(self._path)
+
+
+def serve(db, path=default_socket, debug=False):
+    """ run query server for PaperDB object db """
+
+    s = PaperServer(db, path=path, debug=debug)
+    s.preload()
+    try:
+        asyncio.run(s.serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print('... stop server')
+
+
+class Client(object):
+    """ connection to query server for repeated requests """
+
+    def __init__(self, path=default_socket, timeout=60):
+        """ connect to server socket """
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rb')
+        self._id = 0
+
+    def query(self, cmd, **args):
+        """ send one request and return its result """
+
+        self._id += 1
+        req = {'id': self._id, 'cmd': cmd, 'args': args}
+        self._sock.sendall((json.dumps(req) + '\n').encode('utf-8'))
+
+        res = json.loads(self._file.readline())
+        if not res.get('ok', False):
+            raise RuntimeError(res.get('error', 'no response'))
+        return res['result']
+
+    def close(self):
+        """ close connection """
+
+        self._file.close()
+        self._sock.close()
+
+
+def query(cmd, path=default_socket, **args):
+    """ one request to query server """
+
+    c = Client(path=path)
+    try:
+        return c.query(cmd, **args)
+    finally:
+        c.close()
+
+
+if __name__ == '__main__':
+    # thin client: python server.py search '{"query": "protein folding"}'
+    res = query(sys.argv[1], **(json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}))
+    for r in (res if isinstance(res, list) else [res]):
+        print(json.dumps(r, ensure_ascii=False))
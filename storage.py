@@ -0,0 +1,336 @@
+"""
+storage.py
+
+typed storage of paper database (arrow ipc file, sqlite or csv)
+"""
+
+import os
+import ast
+import importlib.util
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+
+import bibdb
+
+from utils import open_atomic
+
+# column types kept by the storage
+list_columns = ['keywords', 'other-urls']
+bool_columns = ['has_bib', 'read']
+date_columns = ['import_date']
+int_columns = ['year', 'rating']
+
+
+def default_engine():
+    """ use arrow file if pyarrow is installed """
+
+    if importlib.util.find_spec('pyarrow') is not None:
+        return 'arrow'
+    return 'csv'
+
+
+def db_filename(engine='arrow'):
+    """ database file name for storage engine """
+
+    return {'arrow': '.paperdb.arrow', 'csv': '.paperdb.csv', 'sqlite': '.paperdb.sqlite'}[engine]
+
+
+def _to_list(x):
+    """ convert stringified list to list of str """
+
+    if isinstance(x, (list, tuple)):
+        return [ str(k) for k in x ]
+    if hasattr(x, 'tolist'):
+        return [ str(k) for k in x.tolist() ]
+    if not isinstance(x, str) or x in ['', 'nan']:
+        return []
+    if x.startswith('['):
+        try:
+            return [ str(k) for k in ast.literal_eval(x) ]
+        except (ValueError, SyntaxError):
+            pass
+    return [ k.strip() for k in x.split(',') if k.strip() != '' ]
+
+
+def _to_bool(x):
+    """ convert 'True'/'False' strings to bool """
+
+    if isinstance(x, str):
+        return x.strip().lower() in ['true', '1', 'yes']
+    if pd.isna(x):
+        return False
+    return bool(x)
+
+
+def normalize_db(p):
+    """ convert columns to storable types """
+
+    for c in p.columns:
+        if c in list_columns:
+            p[c] = [ _to_list(x) for x in p[c].values ]
+        elif c in bool_columns:
+            p[c] = [ _to_bool(x) for x in p[c].values ]
+        elif c in date_columns:
+            p[c] = pd.to_datetime(p[c], errors='coerce')
+        elif c in int_columns:
+            p[c] = pd.to_numeric(p[c], errors='coerce').fillna(0).astype('int64')
+        elif not (pd.api.types.is_numeric_dtype(p[c]) or pd.api.types.is_bool_dtype(p[c])):
+            p[c] = p[c].fillna('').astype(str)
+
+    return p
+
+
+def read_db(filename, columns=None, memory_map=True):
+    """ read paper database from arrow or csv file """
+
+    if filename.endswith('.sqlite'):
+        db = SQLiteDB(filename)
+        p = db.read(columns=columns)
+        db.close()
+        return p
+
+    if filename.endswith('.csv'):
+        p = pd.read_csv(filename, index_col=0)
+
+        # clean_db sorts and renumbers: keep saved record index
+        p['_idx'] = p.index
+        p = normalize_db(bibdb.clean_db(p)).set_index('_idx').sort_index()
+        p.index.name = None
+        if columns is not None:
+            p = p[columns]
+        return p
+
+    from pyarrow import feather
+
+    table = feather.read_table(filename, columns=columns, memory_map=memory_map)
+    p = table.to_pandas()
+    for c in list_columns:
+        if c in p.columns:
+            p[c] = [ list(x) if x is not None else [] for x in p[c].values ]
+
+    return p
+
+
+def write_db(p, filename, rows=None, rev=None, deleted=()):
+    """ write paper database to arrow, sqlite or csv file (rows: only these rows changed, deleted: rows removed) """
+
+    if filename.endswith('.sqlite'):
+        # sqlite: return revision of this write (None: rows renumbered or replaced since rev)
+        db = SQLiteDB(filename)
+        if rows is None:
+            rev = db.write(normalize_db(p.copy()), rev=rev)
+        else:
+            rev = db.upsert(normalize_db(p.loc[sorted(rows)].copy()), rev=rev, deleted=deleted)
+        db.close()
+        return rev
+
+    # normalize a copy: caller keeps its frame
+    p = normalize_db(p.copy())
+
+    if filename.endswith('.csv'):
+        p.to_csv(filename)
+        return
+
+    from pyarrow import feather
+
+    # uncompressed file can be memory-mapped, record index is kept (gaps after deleted records)
+    with open_atomic(filename, 'wb') as f:
+        feather.write_feather(p, f, compression='uncompressed')
+
+
+def db_revision(filename):
+    """ revision of sqlite database file (0 for other files) """
+
+    if not (filename.endswith('.sqlite') and os.path.exists(filename)):
+        return 0
+    db = SQLiteDB(filename)
+    rev = db.rev()
+    db.close()
+    return rev
+
+
+def insert_db(p, filename):
+    """ insert new rows into sqlite file and return (revision, ids given by sqlite) """
+
+    db = SQLiteDB(filename)
+    rev, ids = db.insert(normalize_db(p.copy()))
+    db.close()
+    return rev, ids
+
+
+def changed_db(filename, rev, exclude=()):
+    """ rows of sqlite file written by others after revision rev """
+
+    db = SQLiteDB(filename)
+    p = db.changed(rev, exclude=exclude)
+    db.close()
+    return p
+
+
+class SQLiteDB(object):
+    """ paper database in sqlite file with row level updates """
+
+    index_columns = ['doi', 'pmid', 'year', 'author1', 'local-url']
+
+    def __init__(self, filename, timeout=30.0):
+        """ open sqlite file in WAL mode """
+
+        self._conn = sqlite3.connect(filename, timeout=timeout)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS papers (idx INTEGER PRIMARY KEY)')
+        self._columns = [ r[1] for r in self._conn.execute('PRAGMA table_info(papers)') ][1:]
+
+        # revision of last write of each row and revision of last full write
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        if '_rev' not in self._columns:
+            with self._conn:
+                self._conn.execute('ALTER TABLE papers ADD COLUMN _rev INTEGER DEFAULT 0')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS ix__rev ON papers (_rev)')
+        else:
+            self._columns.remove('_rev')
+
+    def close(self):
+        """ close connection """
+
+        self._conn.close()
+
+    def rev(self):
+        """ revision of last write (counter in user_version of file) """
+
+        return self._conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def _begin(self):
+        """ start write transaction and return revision of last write """
+
+        self._conn.execute('BEGIN IMMEDIATE')
+        return self.rev()
+
+    def _next(self):
+        """ revision of this write """
+
+        rev = self.rev() + 1
+        self._conn.execute('PRAGMA user_version={:d}'.format(rev))
+        return rev
+
+    def renumbered(self):
+        """ revision of last write replacing all rows """
+
+        r = self._conn.execute("SELECT value FROM meta WHERE key='renumbered'").fetchone()
+        return 0 if r is None else r[0]
+
+    def _add_columns(self, columns):
+        """ add new columns and indexes to table """
+
+        for c in columns:
+            if c in self._columns:
+                continue
+            ctype = 'INTEGER' if c in int_columns + bool_columns else 'TEXT'
+            self._conn.execute('ALTER TABLE papers ADD COLUMN "{}" {}'.format(c, ctype))
+            if c in self.index_columns:
+                self._conn.execute('CREATE INDEX IF NOT EXISTS "ix_{}" ON papers ("{}")'.format(c, c))
+            self._columns.append(c)
+
+    def _encode(self, p, rev, with_idx=True):
+        """ convert frame to rows of sqlite values """
+
+        cols = []
+        for c in p.columns:
+            v = p[c].values
+            if c in list_columns:
+                v = [ json.dumps(list(x)) for x in v ]
+            elif c in date_columns:
+                v = [ None if pd.isna(x) else pd.Timestamp(x).isoformat() for x in v ]
+            elif c in bool_columns:
+                v = [ int(bool(x)) for x in v ]
+            else:
+                v = [ x.item() if isinstance(x, np.generic) else x for x in v ]
+            cols.append(v)
+
+        if not with_idx:
+            return [ tuple(r) + (rev,) for r in zip(*cols) ]
+        return [ (int(i),) + tuple(r) + (rev,) for i, r in zip(p.index, zip(*cols)) ]
+
+    def _insert_sql(self, columns, upsert=False, with_idx=True):
+        """ build insert statement """
+
+        names = [ '"{}"'.format(c) for c in columns ] + ['_rev']
+        if with_idx:
+            names = ['idx'] + names
+        sql = 'INSERT INTO papers ({}) VALUES ({})'.format(', '.join(names), ', '.join(['?'] * len(names)))
+        if upsert:
+            sets = ', '.join([ '"{0}"=excluded."{0}"'.format(c) for c in list(columns) + ['_rev'] ])
+            sql += ' ON CONFLICT(idx) DO UPDATE SET {}'.format(sets)
+        return sql
+
+    def write(self, p, rev=None):
+        """ replace all rows in one transaction (None when rows were written after revision rev) """
+
+        with self._conn:
+            if (self._begin() != rev) and (rev is not None):
+                return None
+            new = self._next()
+            self._add_columns(p.columns)
+            self._conn.execute('DELETE FROM papers')
+            self._conn.executemany(self._insert_sql(p.columns), self._encode(p, new))
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('renumbered', ?)", (new,))
+        return new
+
+    def upsert(self, p, rev=None, deleted=()):
+        """ insert or update rows of frame by index and delete rows deleted
+        (None when rows were renumbered after revision rev) """
+
+        with self._conn:
+            self._begin()
+            if (rev is not None) and (self.renumbered() > rev):
+                return None
+            new = self._next()
+            self._add_columns(p.columns)
+            self._conn.executemany(self._insert_sql(p.columns, upsert=True), self._encode(p, new))
+            self._conn.executemany('DELETE FROM papers WHERE idx=?', [ (int(i),) for i in deleted ])
+        return new
+
+    def insert(self, p):
+        """ insert new rows and return (revision, ids given by sqlite in the same transaction) """
+
+        with self._conn:
+            self._begin()
+            new = self._next()
+            self._add_columns(p.columns)
+            sql = self._insert_sql(p.columns, with_idx=False)
+            ids = [ self._conn.execute(sql, r).lastrowid for r in self._encode(p, new, with_idx=False) ]
+        return new, ids
+
+    def changed(self, rev, exclude=()):
+        """ rows written after revision rev (except revisions in exclude) """
+
+        p = self.read(where='_rev > ?', params=(rev,), rev=True)
+        return p[~p['_rev'].isin(list(exclude))].drop(columns='_rev')
+
+    def read(self, columns=None, where=None, params=(), rev=False):
+        """ read rows as typed frame """
+
+        if columns is None:
+            columns = self._columns
+        names = ', '.join([ '"{}"'.format(c) for c in list(columns) + (['_rev'] if rev else []) ])
+        sql = 'SELECT idx, {} FROM papers'.format(names)
+        if where is not None:
+            sql += ' WHERE ' + where
+        p = pd.read_sql_query(sql + ' ORDER BY idx', self._conn, index_col='idx', params=params)
+        p.index.name = None
+
+        for c in p.columns:
+            if c in list_columns:
+                p[c] = [ json.loads(x) if isinstance(x, str) and x else [] for x in p[c].values ]
+            elif c in date_columns:
+                p[c] = pd.to_datetime(p[c], errors='coerce')
+            elif c in bool_columns:
+                p[c] = p[c].fillna(0).astype(bool)
+            elif c in int_columns:
+                p[c] = p[c].fillna(0).astype('int64')
+            else:
+                p[c] = p[c].fillna('')
+
+        return p
@@ -0,0 +1,68 @@
+"""
+test_import_time.py
+
+startup budget: import py_paperdb and open cached library without heavy dependencies
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import storage
+
+# seconds for import and PaperDB() in a fresh interpreter
+budget = 3.0
+
+lazy_modules = ['sklearn', 'bibtexparser', 'py_readpaper', 'tqdm', 'arxiv2bib', 'requests']
+
+script = """
+import sys, time, json
+t0 = time.time()
+import py_paperdb
+p = py_paperdb.PaperDB(cache=True)
+print(json.dumps({'time': time.time() - t0, 'records': len(p._bibdb),
+                  'loaded': [ m for m in %r if m in sys.modules ]}))
+""" % (lazy_modules,)
+
+
+def _library(dirname, n=50):
+    """ cached database of n records without pdf files """
+
+    p = pd.DataFrame({'year': [ 2000 + i % 20 for i in range(n) ],
+                      'author1': [ 'Kim{}'.format(i % 7) for i in range(n) ],
+                      'author': [ 'Kim{} and Lee'.format(i % 7) for i in range(n) ],
+                      'journal': [ 'Cell' ] * n,
+                      'title': [ 'study number {}'.format(i) for i in range(n) ],
+                      'doi': [ '10.1/{}'.format(i) for i in range(n) ],
+                      'keywords': [ ['a', 'b'] ] * n,
+                      'local-url': [ './{}-Kim-Cell.pdf'.format(i) for i in range(n) ],
+                      'has_bib': [ False ] * n,
+                      'import_date': pd.Timestamp('2020-01-01')})
+    storage.write_db(p, os.path.join(dirname, storage.db_filename(storage.default_engine())))
+
+
+def _run(dirname):
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    out = subprocess.run([sys.executable, '-c', script], cwd=dirname, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_no_heavy_imports(tmp_path):
+    _library(str(tmp_path))
+    res = _run(str(tmp_path))
+
+    assert res['records'] == 50
+    assert res['loaded'] == []
+
+
+def test_import_budget(tmp_path):
+    _library(str(tmp_path))
+    res = _run(str(tmp_path))
+
+    assert res['time'] < budget
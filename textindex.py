@@ -0,0 +1,323 @@
+"""
+textindex.py
+
+inverted token index for full text search of paper database
+"""
+
+import os
+import re
+import sys
+import bisect
+import pickle
+import numpy as np
+
+from utils import open_atomic, safe_pickle_dump
+
+index_columns = ['title', 'abstract', 'author', 'keywords', 'doi', 'local-url']
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+_query_re = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    """ split text into lowercase word tokens """
+
+    return [ sys.intern(t) for t in _token_re.findall(str(text).lower()) ]
+
+
+def _arrays(docs):
+    """ token table, postings and token sequences of docs (idx -> token tuple) as arrays """
+
+    idxs = np.array(sorted(docs.keys()), dtype=np.int64)
+    vocab = sorted(set([ t for tokens in docs.values() for t in tokens ]))
+    tid = { t: i for i, t in enumerate(vocab) }
+
+    lens = np.array([ len(docs[i]) for i in idxs.tolist() ], dtype=np.int64)
+    doc_ptr = np.zeros(len(idxs) + 1, dtype=np.int64)
+    doc_ptr[1:] = np.cumsum(lens)
+    doc_tok = np.fromiter((tid[t] for i in idxs.tolist() for t in docs[i]), dtype=np.int32, count=int(doc_ptr[-1]))
+
+    # one posting per (token, record), records in ascending order
+    key = np.unique(doc_tok.astype(np.int64) * max(len(idxs), 1) + np.repeat(np.arange(len(idxs)), lens))
+    tok = key // max(len(idxs), 1)
+    post = idxs[key % max(len(idxs), 1)]
+    post_ptr = np.searchsorted(tok, np.arange(len(vocab) + 1))
+
+    return vocab, post_ptr, post, idxs, doc_ptr, doc_tok
+
+
+class TextIndex(object):
+    """ token to record index map with phrase and prefix queries
+
+    records are kept in compact arrays (saved as npz file) and changes since the last
+    compaction in small dicts (saved as delta file) """
+
+    def __init__(self, columns=None):
+        """ empty index """
+
+        if columns is None:
+            columns = index_columns
+
+        self._columns = columns
+        self._saved = False         # arrays are the ones in index file
+
+        # compact part: sorted tokens, postings and token sequence of each record
+        self._base_vocab = []
+        self._post_ptr = np.zeros(1, dtype=np.int64)
+        self._post = np.zeros(0, dtype=np.int64)
+        self._doc_idx = np.zeros(0, dtype=np.int64)
+        self._doc_ptr = np.zeros(1, dtype=np.int64)
+        self._doc_tok = np.zeros(0, dtype=np.int32)
+
+        # changes: records added or replaced, records of compact part removed
+        self._postings = {}         # token -> set of idx
+        self._docs = {}             # idx -> token tuple
+        self._removed = set()
+        self._vocab = None          # sorted tokens of changes for prefix match
+
+    def __len__(self):
+        return len(self._doc_idx) - len(self._removed) + len(self._docs)
+
+    def _text(self, row):
+        """ join indexed columns of one record """
+
+        txt = []
+        for c in self._columns:
+            v = row.get(c, '')
+            if isinstance(v, (list, tuple, np.ndarray)):
+                v = ' '.join([ str(x) for x in v ])
+            txt.append(str(v))
+
+        return ' '.join(txt)
+
+    def build(self, pd_db):
+        """ index all records of pandas db """
+
+        cols = [ c for c in self._columns if c in pd_db.columns ]
+        docs = { int(idx): tuple(tokenize(self._text(row))) for idx, row in zip(pd_db.index, pd_db[cols].to_dict('records')) }
+        self._compact(docs)
+        self._saved = False
+
+        return self
+
+    def _compact(self, docs):
+        """ replace compact part by docs and clear changes """
+
+        self._base_vocab, self._post_ptr, self._post, self._doc_idx, self._doc_ptr, self._doc_tok = _arrays(docs)
+        self._postings = {}
+        self._docs = {}
+        self._removed = set()
+        self._vocab = None
+
+    def compact(self):
+        """ merge changes into compact part """
+
+        docs = { idx: self._doc(idx) for idx in self._doc_idx.tolist() if idx not in self._removed }
+        docs.update(self._docs)
+        self._compact(docs)
+        self._saved = False
+
+    def changes(self):
+        """ number of records changed since compaction """
+
+        return len(self._removed | set(self._docs.keys()))
+
+    def add(self, idx, row):
+        """ index one record, replacing the old tokens of idx """
+
+        self.remove(idx)
+
+        tokens = tuple(tokenize(self._text(row)))
+        self._docs[idx] = tokens
+        for t in set(tokens):
+            self._postings.setdefault(t, set()).add(idx)
+        self._vocab = None
+
+    def remove(self, idx):
+        """ remove one record from index """
+
+        if self._base_pos(idx) >= 0:
+            self._removed.add(idx)
+
+        tokens = self._docs.pop(idx, None)
+        if tokens is None:
+            return
+
+        for t in set(tokens):
+            s = self._postings[t]
+            s.discard(idx)
+            if len(s) == 0:
+                del self._postings[t]
+        self._vocab = None
+
+    def _base_pos(self, idx):
+        """ position of record in compact part (-1: not there) """
+
+        i = int(np.searchsorted(self._doc_idx, idx))
+        if i < len(self._doc_idx) and self._doc_idx[i] == idx:
+            return i
+        return -1
+
+    def _tid(self, token):
+        """ token id in compact part (-1: not there) """
+
+        i = bisect.bisect_left(self._base_vocab, token)
+        if i < len(self._base_vocab) and self._base_vocab[i] == token:
+            return i
+        return -1
+
+    def _doc(self, idx):
+        """ token tuple of one record """
+
+        if idx in self._docs:
+            return self._docs[idx]
+        i = self._base_pos(idx)
+        return tuple([ self._base_vocab[t] for t in self._doc_tok[self._doc_ptr[i]:self._doc_ptr[i + 1]].tolist() ])
+
+    def _base_records(self, i):
+        """ records of token id i in compact part """
+
+        res = set(self._post[self._post_ptr[i]:self._post_ptr[i + 1]].tolist())
+        return res - self._removed if len(self._removed) > 0 else res
+
+    def _records(self, token):
+        """ records with token """
+
+        i = self._tid(token)
+        res = self._base_records(i) if i >= 0 else set()
+        return res | self._postings.get(token, set())
+
+    def _count(self, token):
+        """ approximate number of records with token """
+
+        i = self._tid(token)
+        n = (self._post_ptr[i + 1] - self._post_ptr[i]) if i >= 0 else 0
+        return n + len(self._postings.get(token, ()))
+
+    def _prefix(self, prefix):
+        """ records with any token starting with prefix """
+
+        if self._vocab is None:
+            self._vocab = sorted(self._postings.keys())
+
+        res = set()
+        i = bisect.bisect_left(self._base_vocab, prefix)
+        while i < len(self._base_vocab) and self._base_vocab[i].startswith(prefix):
+            res |= self._base_records(i)
+            i += 1
+
+        i = bisect.bisect_left(self._vocab, prefix)
+        while i < len(self._vocab) and self._vocab[i].startswith(prefix):
+            res |= self._postings[self._vocab[i]]
+            i += 1
+
+        return res
+
+    def _phrase(self, tokens):
+        """ records with tokens in consecutive order """
+
+        res = self._all(tokens)
+        if len(tokens) < 2:
+            return res
+
+        n = len(tokens)
+        first = tokens[0]
+        tokens = tuple(tokens)
+        out = set()
+        for idx in res:
+            doc = self._doc(idx)
+            for i, t in enumerate(doc[:len(doc) - n + 1]):
+                if t == first and doc[i:i + n] == tokens:
+                    out.add(idx)
+                    break
+
+        return out
+
+    def _all(self, tokens):
+        """ records with all tokens """
+
+        res = None
+        for t in sorted(tokens, key=self._count):
+            s = self._records(t)
+            res = s if res is None else res & s
+            if len(res) == 0:
+                break
+
+        return res if res is not None else set()
+
+    def _term(self, term, phrase=False):
+        """ records matching one query term """
+
+        if (not phrase) and term.endswith('*'):
+            tokens = tokenize(term[:-1])
+            if len(tokens) == 0:
+                return set()
+            # last token is prefix, others must match in order
+            res = self._prefix(tokens[-1])
+            if len(tokens) > 1:
+                res &= self._phrase(tokens[:-1])
+            return res
+
+        return self._phrase(tokenize(term))
+
+    def query(self, qstr):
+        """ search index: words are AND, OR between groups, "phrase", prefix* """
+
+        groups = [[]]
+        for phrase, word in _query_re.findall(qstr):
+            if word == 'OR':
+                groups.append([])
+            elif word == 'AND':
+                continue
+            elif phrase != '':
+                groups[-1].append(self._term(phrase, phrase=True))
+            else:
+                groups[-1].append(self._term(word))
+
+        res = set()
+        for g in groups:
+            if len(g) == 0:
+                continue
+            hit = g[0]
+            for s in g[1:]:
+                hit = hit & s
+            res |= hit
+
+        return sorted(res)
+
+    def save(self, fname):
+        """ write compact part as uncompressed npz file (call compact first to include changes) """
+
+        with open_atomic(fname, 'wb') as f:
+            np.savez(f, vocab=np.frombuffer('\n'.join(self._base_vocab).encode('utf-8'), dtype=np.uint8),
+                     columns=np.frombuffer('\n'.join(self._columns).encode('utf-8'), dtype=np.uint8),
+                     post_ptr=self._post_ptr, post=self._post, doc_idx=self._doc_idx, doc_ptr=self._doc_ptr, doc_tok=self._doc_tok)
+        self._saved = True
+
+    def save_changes(self, fname):
+        """ write changes since compaction (small pickle) """
+
+        safe_pickle_dump({'docs': self._docs, 'removed': self._removed}, fname)
+
+    @classmethod
+    def load(cls, fname, changes_fname=None):
+        """ read npz file and changes file if it exists """
+
+        a = np.load(fname)
+        vocab = a['vocab'].tobytes().decode('utf-8')
+
+        index = cls(columns=a['columns'].tobytes().decode('utf-8').split('\n'))
+        index._base_vocab = vocab.split('\n') if vocab != '' else []
+        for k in ['post_ptr', 'post', 'doc_idx', 'doc_ptr', 'doc_tok']:
+            setattr(index, '_' + k, a[k])
+        index._saved = True
+
+        if (changes_fname is not None) and os.path.exists(changes_fname):
+            changes = pickle.load(open(changes_fname, 'rb'))
+            index._removed = set(changes['removed'])
+            for idx, tokens in changes['docs'].items():
+                index._docs[idx] = tokens
+                for t in set(tokens):
+                    index._postings.setdefault(t, set()).add(idx)
+
+        return index
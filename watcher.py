@@ -0,0 +1,157 @@
+"""
+watcher.py
+
+move new pdf files from inbox directory into paper database
+"""
+
+import os
+import glob
+import time
+import shutil
+
+import bibdb
+import filedb
+
+
+def _open_inotify(dirname):
+    """ inotify watch of directory (None without inotify_simple) """
+
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return None
+
+    ino = INotify()
+    ino.add_watch(dirname, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO)
+    return ino
+
+
+class Watcher(object):
+    """ ingest pdf files of inbox once their size and mtime are stable """
+
+    def __init__(self, db, inbox, settle=2.0, interval=1.0, debug=False):
+        """ watch inbox for PaperDB object db """
+
+        self._db = db
+        self._inbox = inbox
+        self._settle = settle
+        self._interval = interval
+        self._debug = debug
+        self._pending = {}          # file -> ((size, mtime), time of last change)
+        self._failed = {}           # file -> (size, mtime) not readable or already in library
+        self._inotify = _open_inotify(inbox)
+
+        if self._inotify is None:
+            print('... watch {} by polling every {} s'.format(inbox, interval))
+        else:
+            print('... watch {} by inotify'.format(inbox))
+
+    def _wait(self):
+        """ sleep until inotify event or interval """
+
+        if self._inotify is None:
+            time.sleep(self._interval)
+        else:
+            self._inotify.read(timeout=int(self._interval * 1000))
+
+    def _scan(self):
+        """ update stat of pdf files in inbox """
+
+        now = time.time()
+        files = set(glob.glob(os.path.join(self._inbox, '*.pdf')))
+
+        for f in list(self._pending.keys()):
+            if f not in files:
+                del self._pending[f]
+
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            key = (st.st_size, st.st_mtime_ns)
+            if self._failed.get(f) == key:
+                continue
+            if (f not in self._pending) or (self._pending[f][0] != key):
+                self._pending[f] = (key, now)
+
+    def ready(self):
+        """ files not changed for settle seconds """
+
+        now = time.time()
+        return sorted([ f for f, (key, t) in self._pending.items() if (key[0] > 0) and (now - t >= self._settle) ])
+
+    def _read(self, flist):
+        """ filedb rows of readable files """
+
+        try:
+            return filedb.build_filedb(workers=self._db._workers, debug=self._debug, flist=flist)
+        except Exception:
+            pass
+
+        # find unreadable files one by one and keep items of readable files
+        good = []
+        items = []
+        for f in flist:
+            try:
+                items.append(filedb.read_paper(f))
+                good.append(f)
+            except Exception as e:
+                print('... error reading: {} ({})'.format(f, e))
+                self._failed[f] = self._pending[f][0]
+        if len(good) == 0:
+            return None
+        return filedb.build_filedb(debug=self._debug, flist=good, items=items)
+
+    def ingest(self, flist):
+        """ read files, move them with bib files into library and add their records """
+
+        p = self._read(flist)
+        keys = {}
+        for f in flist:
+            if f in self._pending:
+                keys[f] = self._pending.pop(f)[0]
+        if p is None:
+            return []
+
+        urls = []
+        for f in p['local-url']:
+            dst = os.path.join(self._db._dirname, os.path.basename(f))
+            if os.path.exists(dst):
+                # not read again until the file changes
+                print('... file exists in library: {}'.format(dst))
+                self._failed[f] = keys.get(f)
+                urls.append(None)
+                continue
+
+            shutil.move(f, dst)
+            if os.path.exists(filedb.bib_filename(f)):
+                shutil.move(filedb.bib_filename(f), filedb.bib_filename(dst))
+            urls.append(dst)
+            print('... move {} -> {}'.format(f, dst))
+
+        p['local-url'] = urls
+        p = p[p['local-url'].notna()]
+        if len(p) == 0:
+            return []
+
+        return self._db.add_records(bibdb.clean_db(p))
+
+    def step(self):
+        """ scan inbox once and ingest settled files """
+
+        self._scan()
+        flist = self.ready()
+        if len(flist) > 0:
+            return self.ingest(flist)
+        return []
+
+    def run(self):
+        """ watch until interrupted """
+
+        try:
+            while True:
+                self.step()
+                self._wait()
+        except KeyboardInterrupt:
+            print('... stop watching')